@@ -1,69 +1,26 @@
 import os
-import cv2
+import glob
+import re
 import numpy as np
 import time
-import matplotlib.pyplot as plt
 import pandas as pd
-from datetime import datetime
+from volume_tracker import (DETECTORS, DebugImageWriter, MeniscusTracker, RoiChangeDetector, StreamingOutlierFilter,
+                            clean_volume_series, extract_crops, iter_measurements, list_images, open_crop_cache,
+                            print_search_summary, read_container_calibrations, read_detection_params,
+                            save_results, write_outlier_debug_images)
+from stage_profiler import PROFILER
 
 CREATE_ANIMATIONS = True
 
-def read_calibration(file_path):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-        shape = lines[0].split(':')[1].strip()
-        min_volume = float(lines[1].split(':')[1].strip())
-        max_volume = float(lines[2].split(':')[1].strip())
-        instructions = lines[3].split(':')[1].strip()
-    return shape, min_volume, max_volume, instructions
-
-def calculate_height(roi, frame, processed_dir, blur_dir, filename):
-    roi_frame = frame[int(roi[1]):int(roi[1] + roi[3]), int(roi[0]):int(roi[0] + roi[2])]
-    gray_frame = cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY)
-    _, binary_frame = cv2.threshold(gray_frame, 30, 255, cv2.THRESH_BINARY)
-    blurred_frame = cv2.GaussianBlur(binary_frame, (55, 5), 0)
-
-    blur_image_path = os.path.join(blur_dir, filename)
-    cv2.imwrite(blur_image_path, blurred_frame)
-
-    v = np.median(blurred_frame)
-    lower = int(max(0, 0.4 * v))
-    upper = int(min(255, 1.6 * v))
-    edges = cv2.Canny(blurred_frame, lower, upper)
-    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    processed_image = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-    cv2.drawContours(processed_image, contours, -1, (0, 255, 0), 2)
-    processed_image_path = os.path.join(processed_dir, filename)
-    cv2.imwrite(processed_image_path, processed_image)
-
-    if not contours:
-        return 0
-
-    contours = sorted(contours, key=lambda c: cv2.boundingRect(c)[1])
-    longest_contour = None
-    max_length = 0
-
-    for contour in contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        aspect_ratio = w / float(h)
-
-        if aspect_ratio > 2.0:
-            length = cv2.arcLength(contour, True)
-            if length > max_length:
-                max_length = length
-                longest_contour = contour
-
-    if longest_contour is None:
-        return 0
-
-    x, y, w, h = cv2.boundingRect(longest_contour)
-    height = roi[3] - y
-    return height
+DETECTION_PARAMS = {'threshold': 30, 'blur_kernel': (55, 5), 'min_aspect_ratio': 2.0}
 
+# Volumes above this are never physical for the cluster runs
+MAX_VOLUME = 7
+
+@PROFILER.timed()
 def remove_outliers_and_interpolate(volumes, threshold=2):
     volumes = np.array(volumes)
-    volumes[volumes > 7] = np.nan
+    volumes[volumes > MAX_VOLUME] = np.nan
 
     mean_volume = np.nanmean(volumes)
     std_volume = np.nanstd(volumes)
@@ -76,81 +33,238 @@ def remove_outliers_and_interpolate(volumes, threshold=2):
     clean_volumes = pd.Series(clean_volumes).interpolate().to_numpy()
     return clean_volumes
 
-def process_images(directory, r1, r2, shape, min_volume, max_volume):
+@PROFILER.timed()
+def process_images(directory, rois, calibrations, workers=1, use_cache=True,
+                   debug_images='all', debug_every=10, detector='contour', cleaning='batch', change_detector=None,
+                   tracker=None, crop_cache=False, params=DETECTION_PARAMS):
     volumes = []
     timestamps = []
     raw_heights = []
-    frames = []
-
-    processed_dir = os.path.join(directory, "processed_images")
-    blur_dir = os.path.join(directory, "blur_images")
-    container1_processed_dir = os.path.join(processed_dir, "container1")
-    container2_processed_dir = os.path.join(processed_dir, "container2")
-    container1_blur_dir = os.path.join(blur_dir, "container1")
-    container2_blur_dir = os.path.join(blur_dir, "container2")
-
-    for dir_path in [processed_dir, blur_dir, container1_processed_dir, container2_processed_dir, container1_blur_dir,
-                     container2_blur_dir]:
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-
-    for filename in sorted(os.listdir(directory)):
-        if filename.endswith(".jpg"):
-            filepath = os.path.join(directory, filename)
-            frame = cv2.imread(filepath)
-            frames.append(frame)
-            timestamp = time.strptime(filename.split('.')[0], "%Y%m%d-%H%M%S")
+    image_paths = []
+    crops = extract_crops(directory, rois, workers=workers) if crop_cache else None
+
+    # The measurement itself is shared with volume_tracker.py, run with this script's detection parameters
+    # unless others are given
+    debug_writer = None
+    if debug_images != 'off' and detector != 'profile':
+        debug_writer = DebugImageWriter(debug_images, debug_every)
+    try:
+        for filename, timestamp, heights, frame_volumes in iter_measurements(
+                directory, rois, calibrations, workers, use_cache,
+                params=params, debug_writer=debug_writer, detector=detector,
+                change_detector=change_detector, tracker=tracker, crops=crops):
+            image_paths.append(os.path.join(directory, filename))
             timestamps.append(timestamp)
-
-            height1 = calculate_height(r1, frame, container1_processed_dir, container1_blur_dir, filename)
-            height2 = calculate_height(r2, frame, container2_processed_dir, container2_blur_dir, filename)
-
-            container_height1 = r1[3]
-            container_height2 = r2[3]
-
-            volume1 = calculate_volume(height1, min_volume, max_volume, container_height1, shape)
-            volume2 = calculate_volume(height2, min_volume, max_volume, container_height2, shape)
-
-            volumes.append((volume1, volume2))
-            raw_heights.append((height1, height2))
-
-    volume1_list = [v[0] for v in volumes]
-    volume2_list = [v[1] for v in volumes]
-
-    clean_volume1 = remove_outliers_and_interpolate(volume1_list)
-    clean_volume2 = remove_outliers_and_interpolate(volume2_list)
-
-    cleaned_volumes = list(zip(clean_volume1, clean_volume2))
-    return timestamps, cleaned_volumes, raw_heights, frames
-
-def calculate_volume(height, min_volume, max_volume, container_height, shape):
-    if shape == 'cylindrical':
-        return min_volume + (height / container_height) * (max_volume - min_volume)
-    else:
-        raise ValueError("Unsupported shape")
-
-def save_results(timestamps, volumes, raw_heights, output_file):
-    with open(output_file, 'w') as f:
-        f.write("Timestamp,Height1,Height2,Volume1,Volume2,TotalVolume\n")
-        for timestamp, (volume1, volume2), (height1, height2) in zip(timestamps, volumes, raw_heights):
-            total_volume = volume1 + volume2
-            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S', timestamp)},{height1:.2f},{height2:.2f},{volume1:.2f},{volume2:.2f},{total_volume:.2f}\n")
+            volumes.append(frame_volumes)
+            raw_heights.append(heights)
+        print_search_summary(change_detector, tracker)
+
+        cleaned_volumes = clean_volumes(volumes, cleaning)
+
+        write_outlier_debug_images(directory, [os.path.basename(path) for path in image_paths], volumes,
+                                   cleaned_volumes, rois, params=params, debug_writer=debug_writer, detector=detector,
+                                   crops=crops)
+    finally:
+        if debug_writer is not None:
+            debug_writer.close()
+
+    return timestamps, cleaned_volumes, raw_heights, image_paths
+
+def clean_volumes(volumes, cleaning='batch'):
+    """
+    Outlier cleaning over the full series: the global z-score pass ('batch') or the rolling
+    Hampel filter ('streaming'), per container.
+    """
+    if cleaning == 'streaming':
+        filters = [StreamingOutlierFilter(max_volume=MAX_VOLUME) for _ in volumes[0]]
+        return [tuple(f.update(v)[0] for f, v in zip(filters, frame_volumes)) for frame_volumes in volumes]
+    return clean_volume_series(volumes, remove_outliers_and_interpolate)
+
+def shard_filenames(filenames, shard_index, shard_count):
+    # A contiguous block of the sorted images, so every shard covers one stretch of the experiment
+    bounds = np.linspace(0, len(filenames), shard_count + 1).round().astype(int)
+    return filenames[bounds[shard_index]:bounds[shard_index + 1]]
+
+def shard_file(directory, shard_index, shard_count):
+    return os.path.join(directory, f"raw_heights_shard{shard_index:03d}_of{shard_count:03d}.csv")
+
+@PROFILER.timed()
+def process_shard(directory, rois, calibrations, shard_index, shard_count, workers=1, use_cache=True,
+                  debug_images='all', debug_every=10, detector='contour', change_detector=None, tracker=None,
+                  crop_cache=False, params=DETECTION_PARAMS):
+    """
+    Measure one shard of the images and write its raw heights and volumes to a partial file,
+    for merge_shards to clean and save once all shards are done. Each shard keeps its own height
+    cache, so shards running at the same time never write to the same file. For the same reason
+    shards only read the crop cache (made beforehand with --extract-crops), they never write it.
+    """
+    filenames = shard_filenames(list_images(directory), shard_index, shard_count)
+    crops = open_crop_cache(directory, rois) if crop_cache else None
+    if crop_cache and crops is None:
+        print(f"No crop cache for these ROIs in {directory} (run --extract-crops first), decoding the images")
+    output_file = shard_file(directory, shard_index, shard_count)
+    cache_file = os.path.join(directory, f"height_cache_shard{shard_index:03d}_of{shard_count:03d}.json")
+
+    # Outliers are only known after the merge, so 'flagged' only keeps frames without a meniscus here
+    debug_writer = None
+    if debug_images != 'off' and detector != 'profile':
+        debug_writer = DebugImageWriter(debug_images, debug_every)
+    # The partial file only appears under its final name once the shard is complete
+    tmp_file = output_file + '.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            f.write(','.join(['Filename'] + [f"Height{i + 1}" for i in range(len(rois))]
+                             + [f"Volume{i + 1}" for i in range(len(rois))]) + "\n")
+            for filename, timestamp, heights, frame_volumes in iter_measurements(
+                    directory, rois, calibrations, workers, use_cache, params=params,
+                    debug_writer=debug_writer, detector=detector, filenames=filenames, cache_file=cache_file,
+                    change_detector=change_detector, tracker=tracker, crops=crops):
+                # repr keeps the volumes exact, so the merged results match a single run
+                f.write(','.join([filename] + [str(h) for h in heights] + [repr(float(v)) for v in frame_volumes])
+                        + "\n")
+    finally:
+        if debug_writer is not None:
+            debug_writer.close()
+    os.replace(tmp_file, output_file)
+    print_search_summary(change_detector, tracker)
+    print(f"Shard {shard_index} of {shard_count}: {len(filenames)} images written to {output_file}")
+    return output_file
+
+@PROFILER.timed()
+def merge_shards(directory, cleaning='batch'):
+    """
+    Concatenate the partial files of all shards in timestamp order, then run the outlier cleaning
+    and save_results once over the full series.
+    """
+    shard_files = glob.glob(os.path.join(directory, "raw_heights_shard*_of*.csv"))
+    counts = {int(re.search(r'_of(\d+)\.csv$', f).group(1)) for f in shard_files}
+    if len(counts) != 1:
+        raise ValueError(f"Expected the partial files of one sharded run in {directory}, found {len(shard_files)} "
+                         f"files for shard counts {sorted(counts)}")
+    shard_count = counts.pop()
+    missing = [i for i in range(shard_count) if shard_file(directory, i, shard_count) not in shard_files]
+    if missing:
+        raise ValueError(f"Shards {missing} of {shard_count} have not finished")
+
+    rows = []
+    for filename in shard_files:
+        with open(filename, 'r') as f:
+            header = f.readline().strip().split(',')
+            n_containers = (len(header) - 1) // 2
+            for line in f:
+                fields = line.strip().split(',')
+                rows.append((fields[0], tuple(int(float(h)) for h in fields[1:1 + n_containers]),
+                             tuple(float(v) for v in fields[1 + n_containers:])))
+    # The image names are timestamps, so sorting by name puts the series in time order
+    rows.sort()
+
+    timestamps = [time.strptime(filename.split('.')[0], "%Y%m%d-%H%M%S") for filename, _, _ in rows]
+    raw_heights = [heights for _, heights, _ in rows]
+    volumes = clean_volumes([frame_volumes for _, _, frame_volumes in rows], cleaning)
+    output_file = os.path.join(directory, "volumes.csv")
+    save_results(timestamps, volumes, raw_heights, output_file, [filename for filename, _, _ in rows])
+    print(f"Merged {len(rows)} images from {shard_count} shards")
+    return output_file
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Process volume tracking images.")
     parser.add_argument('--directory', required=True, help="Directory containing the images")
-    parser.add_argument('--calibration', required=True, help="Calibration file path")
-    parser.add_argument('--r1', type=int, nargs=4, required=True, help="ROI 1 coordinates: x y width height")
-    parser.add_argument('--r2', type=int, nargs=4, required=True, help="ROI 2 coordinates: x y width height")
+    parser.add_argument('--calibration', nargs='+',
+                        help="Calibration file path, or one calibration file per ROI")
+    parser.add_argument('--roi', type=int, nargs=4, action='append',
+                        help="ROI coordinates: x y width height. Repeat once per container")
+    parser.add_argument('--r1', type=int, nargs=4, help="ROI 1 coordinates: x y width height")
+    parser.add_argument('--r2', type=int, nargs=4, help="ROI 2 coordinates: x y width height")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    parser.add_argument('--no-cache', action='store_true', help="Ignore height_cache.json and reanalyse every image")
+    parser.add_argument('--debug-images', choices=DebugImageWriter.POLICIES, default='all',
+                        help="Which blur/contour debug images to save (default: all)")
+    parser.add_argument('--detector', choices=DETECTORS, default='contour',
+                        help="Meniscus detector: per-frame contours, vectorised row profiles or coarse-to-fine "
+                             "contours (default: contour)")
+    parser.add_argument('--cleaning', choices=('batch', 'streaming'), default='batch',
+                        help="Outlier cleaning: global z-score pass or rolling Hampel filter (default: batch)")
+    parser.add_argument('--debug-every', type=int, default=10,
+                        help="Save debug images for every Nth analysed frame with --debug-images every")
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help="Reuse the previous height for ROIs that have not changed since they were last measured")
+    parser.add_argument('--change-tolerance', type=float, default=8,
+                        help="Grey levels a 4x4 pixel cell of a ROI may change by and still count as unchanged "
+                             "(default: 8)")
+    parser.add_argument('--force-every', type=int, default=30,
+                        help="Measure a ROI again after this many skips in a row (default: 30)")
+    parser.add_argument('--track', action='store_true',
+                        help="Search for the meniscus in a band around its previous position before searching the "
+                             "whole ROI")
+    parser.add_argument('--track-band', type=int, default=20,
+                        help="Rows above and below the previous meniscus searched with --track (default: 20)")
+    parser.add_argument('--rescan-every', type=int, default=50,
+                        help="Search the whole ROI every this many frames with --track (default: 50)")
+    parser.add_argument('--crop-cache', action='store_true',
+                        help="Measure from the memory-mapped ROI crops in the roi_crops directory, extracting them "
+                             "first if needed (shards only read an existing crop cache)")
+    parser.add_argument('--extract-crops', action='store_true',
+                        help="Only decode the images into the crop cache, e.g. once before a sharded run")
+    parser.add_argument('--detection-config',
+                        help="Take the detection parameters from this JSON config, e.g. as written by "
+                             "tune_detection.py")
+    parser.add_argument('--shard-index', type=int,
+                        help="Only process this shard (0 to shard count - 1) and write its raw heights to a "
+                             "partial file, e.g. --shard-index $SLURM_ARRAY_TASK_ID")
+    parser.add_argument('--shard-count', type=int, help="Number of shards the images are split into")
+    parser.add_argument('--profile', metavar='REPORT_FILE',
+                        help="Time every stage of the run and write the timings to this JSON file")
+    parser.add_argument('--merge', action='store_true',
+                        help="Merge the partial files of all shards, clean the series and save volumes.csv")
 
     args = parser.parse_args()
+    if args.profile:
+        PROFILER.enable()
 
-    shape, min_volume, max_volume, instructions = read_calibration(args.calibration)
-
-    timestamps, volumes, raw_heights, frames = process_images(args.directory, args.r1, args.r2, shape, min_volume, max_volume)
-    output_file = os.path.join(args.directory, "volumes.csv")
-    save_results(timestamps, volumes, raw_heights, output_file)
-
-    print(f"Results saved to {output_file}")
\ No newline at end of file
+    if args.merge:
+        output_file = merge_shards(args.directory, args.cleaning)
+        print(f"Results saved to {output_file}")
+    else:
+        # --r1/--r2 are the original two-container options; --roi takes any number of containers
+        rois = args.roi or [roi for roi in (args.r1, args.r2) if roi is not None]
+        if not rois:
+            parser.error("give the ROIs with --roi (or --r1 and --r2)")
+        if not args.calibration:
+            parser.error("--calibration is required")
+        calibrations = read_container_calibrations(args.calibration, len(rois))
+        change_detector = RoiChangeDetector(args.change_tolerance, args.force_every) if args.skip_unchanged else None
+        tracker = MeniscusTracker(args.track_band, args.rescan_every) if args.track else None
+        params = (read_detection_params(args.detection_config, DETECTION_PARAMS) if args.detection_config
+                  else DETECTION_PARAMS)
+
+        if args.extract_crops:
+            crops = extract_crops(args.directory, rois, workers=args.workers)
+            print(f"ROI crops of {len(crops)} images in {crops.path}")
+        elif args.shard_count is not None:
+            if args.shard_index is None or not 0 <= args.shard_index < args.shard_count:
+                parser.error("--shard-count needs a --shard-index from 0 to shard count - 1")
+            process_shard(args.directory, rois, calibrations, args.shard_index, args.shard_count,
+                          workers=args.workers, use_cache=not args.no_cache, debug_images=args.debug_images,
+                          debug_every=args.debug_every, detector=args.detector, change_detector=change_detector,
+                          tracker=tracker, crop_cache=args.crop_cache, params=params)
+        else:
+            timestamps, volumes, raw_heights, image_paths = process_images(args.directory, rois, calibrations,
+                                                                              workers=args.workers,
+                                                                              use_cache=not args.no_cache,
+                                                                              debug_images=args.debug_images,
+                                                                              debug_every=args.debug_every,
+                                                                              detector=args.detector,
+                                                                              cleaning=args.cleaning,
+                                                                              change_detector=change_detector,
+                                                                              tracker=tracker,
+                                                                              crop_cache=args.crop_cache,
+                                                                              params=params)
+            output_file = os.path.join(args.directory, "volumes.csv")
+            save_results(timestamps, volumes, raw_heights, output_file, image_paths)
+
+            print(f"Results saved to {output_file}")
+
+    if args.profile:
+        PROFILER.write_report(args.profile)
@@ -0,0 +1,205 @@
+"""
+Benchmark the volume tracking pipeline on synthetic images, no camera needed.
+
+Generates a run of synthetic vial images with a known meniscus height in two containers,
+with sensor noise, a tilted meniscus and a slow drift in lighting, then times each stage
+of the pipeline separately:
+- decode: cv2.imread of every frame
+- calculate_height: the meniscus detection for both ROIs, with the chosen detector
+- remove_outliers_and_interpolate
+- save_results
+- animation: render_animation (or create_combined_animation) on the first frames of the run
+
+For each stage it reports the time, frames per second and the peak RSS of the process
+so far, plus the mean error of the detected heights against the known ones.
+
+Example:
+    python benchmark.py --frames 500 --resolution 480x640 --json bench.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from volume_tracker import (DETECTION_PARAMS, DETECTORS, PROFILE_BATCH_SIZE, calculate_height, compile_calibration,
+                            create_combined_animation, heights_to_volumes, list_images, profile_heights,
+                            pyramid_height, remove_outliers_and_interpolate, render_animation, save_results)
+
+BACKGROUND_LEVEL = 200
+TUBE_LEVEL = 225
+LIQUID_LEVEL = 40
+
+
+def vial_rois(width, height):
+    # Two tubes at a third and two thirds of the width, each a tenth of the frame wide
+    tube_width = max(8, width // 10)
+    top, bottom = int(0.2 * height), int(0.85 * height)
+    return [(int(centre * width) - tube_width // 2, top, tube_width, bottom - top) for centre in (1 / 3, 2 / 3)]
+
+
+def liquid_heights(n_frames, roi_height, rng):
+    """
+    Known liquid heights for both containers: liquid is pumped back and forth between them,
+    with plateaus in between, so the total stays constant.
+    """
+    phase = np.linspace(0, 4 * np.pi, n_frames)
+    transfer = np.clip(1.5 * np.sin(phase), -1, 1)
+    level1 = 0.5 + 0.3 * transfer + rng.normal(0, 0.002, n_frames)
+    level2 = 1.0 - level1
+    return np.round(np.column_stack([level1, level2]) * roi_height).astype(int)
+
+
+def make_synthetic_frame(width, height, rois, heights, noise=6.0, tilt=3, lighting=1.0, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    frame = np.full((height, width), BACKGROUND_LEVEL, dtype=np.float32)
+    columns = np.arange(width)
+
+    for (x, y, w, h), liquid_height in zip(rois, heights):
+        # Tube wall slightly wider than the ROI, liquid below a meniscus tilted by `tilt` pixels
+        frame[y - 10:y + h + 10, x - 4:x + w + 4] = TUBE_LEVEL
+        meniscus = y + h - liquid_height + np.round(np.linspace(-tilt / 2, tilt / 2, w)).astype(int)
+        for column, row in zip(columns[x:x + w], meniscus):
+            frame[row:y + h + 10, column] = LIQUID_LEVEL
+
+    frame = frame * lighting + rng.normal(0, noise, frame.shape)
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def generate_dataset(directory, n_frames, width, height, noise=6.0, tilt=3, lighting_drift=0.15, seed=0):
+    """
+    Write n_frames synthetic JPEGs, one minute apart, named like the capture script does.
+    Returns the ROIs and the known heights.
+    """
+    rng = np.random.default_rng(seed)
+    rois = vial_rois(width, height)
+    heights = liquid_heights(n_frames, rois[0][3], rng)
+    start = time.mktime(time.strptime("20240101-000000", "%Y%m%d-%H%M%S"))
+
+    for i, frame_heights in enumerate(heights):
+        lighting = 1.0 - lighting_drift * (0.5 - 0.5 * np.cos(2 * np.pi * i / max(1, n_frames)))
+        frame = make_synthetic_frame(width, height, rois, frame_heights, noise, tilt, lighting, rng)
+        filename = time.strftime("%Y%m%d-%H%M%S", time.localtime(start + 60 * i)) + ".jpg"
+        cv2.imwrite(os.path.join(directory, filename), frame)
+    return rois, heights
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(directory, rois, true_heights, detector='contour', animation_frames=50, renderer='fast'):
+    filenames = list_images(directory)
+    n_frames = len(filenames)
+    stages = {}
+
+    def record(stage, seconds, frames):
+        stages[stage] = {'seconds': seconds, 'frames_per_second': frames / seconds if seconds else float('inf'),
+                         'peak_rss_mb': peak_rss_mb()}
+
+    # Decode and detection are timed per frame so no decoded frames have to be kept around
+    decode_time = 0.0
+    height_time = 0.0
+    heights = []
+    crops = [[] for _ in rois]
+    for filename in filenames:
+        start = time.perf_counter()
+        frame = cv2.imread(os.path.join(directory, filename))
+        decode_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        if detector == 'contour':
+            heights.append([calculate_height(roi, frame, None, None, filename) for roi in rois])
+        elif detector == 'pyramid':
+            heights.append([pyramid_height(roi, frame, None, None, filename) for roi in rois])
+        else:
+            for roi_crops, (x, y, w, h) in zip(crops, rois):
+                roi_crops.append(cv2.cvtColor(frame[y:y + h, x:x + w], cv2.COLOR_BGR2GRAY))
+            if len(crops[0]) == PROFILE_BATCH_SIZE or filename == filenames[-1]:
+                heights.extend(zip(*[profile_heights(np.stack(roi_crops)) for roi_crops in crops]))
+                crops = [[] for _ in rois]
+        height_time += time.perf_counter() - start
+    heights = np.array(heights)
+
+    record('decode', decode_time, n_frames)
+    record('calculate_height', height_time, n_frames)
+
+    calibration = {'shape': 'cylindrical', 'min_volume': 1, 'max_volume': 8}
+    volumes = np.column_stack([heights_to_volumes(heights[:, i], compile_calibration(calibration, roi[3]))
+                               for i, roi in enumerate(rois)])
+    start = time.perf_counter()
+    clean_volumes = list(zip(*[remove_outliers_and_interpolate([v[i] for v in volumes]) for i in range(len(rois))]))
+    record('remove_outliers_and_interpolate', time.perf_counter() - start, n_frames)
+
+    timestamps = [time.strptime(f.split('.')[0], "%Y%m%d-%H%M%S") for f in filenames]
+    start = time.perf_counter()
+    save_results(timestamps, clean_volumes, [tuple(h) for h in heights], os.path.join(directory, "volumes.csv"))
+    record('save_results', time.perf_counter() - start, n_frames)
+
+    if animation_frames:
+        n = min(animation_frames, n_frames)
+        image_paths = [os.path.join(directory, f) for f in filenames[:n]]
+        start = time.perf_counter()
+        if renderer == 'fast':
+            render_animation(image_paths, timestamps[:n], clean_volumes[:n], os.path.join(directory, "animation.gif"),
+                             scale=0.5, max_frames=None)
+        else:
+            create_combined_animation(image_paths, timestamps[:n], clean_volumes[:n],
+                                      os.path.join(directory, "animation.gif"), scale=0.5)
+        record('animation', time.perf_counter() - start, n)
+
+    error = np.abs(heights - true_heights)
+    return {'frames': n_frames, 'detector': detector, 'stages': stages,
+            'mean_abs_height_error_px': float(error.mean()),
+            'missed_frames': int((heights == 0).any(axis=1).sum())}
+
+
+def print_report(report):
+    print(f"{report['frames']} frames, {report['detector']} detector")
+    print(f"{'stage':<34}{'seconds':>9}{'frames/s':>11}{'peak RSS MB':>13}")
+    for stage, result in report['stages'].items():
+        print(f"{stage:<34}{result['seconds']:>9.3f}{result['frames_per_second']:>11.1f}{result['peak_rss_mb']:>13.1f}")
+    print(f"Mean height error: {report['mean_abs_height_error_px']:.2f} px, "
+          f"frames without a meniscus: {report['missed_frames']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the volume tracker on synthetic images.")
+    parser.add_argument('--frames', type=int, default=300, help="Number of synthetic frames (default: 300)")
+    parser.add_argument('--resolution', default='480x640', help="Frame size as WIDTHxHEIGHT (default: 480x640)")
+    parser.add_argument('--noise', type=float, default=6.0, help="Standard deviation of the pixel noise")
+    parser.add_argument('--tilt', type=int, default=3, help="Height difference across the meniscus in pixels")
+    parser.add_argument('--lighting-drift', type=float, default=0.15,
+                        help="Fraction by which the brightness dims and recovers over the run")
+    parser.add_argument('--detector', choices=DETECTORS, default='contour', help="Meniscus detector to benchmark")
+    parser.add_argument('--animation-frames', type=int, default=50,
+                        help="Number of frames to animate (0 skips the animation stage)")
+    parser.add_argument('--renderer', choices=('fast', 'matplotlib'), default='fast',
+                        help="Animation renderer to benchmark (default: fast)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for the synthetic images")
+    parser.add_argument('--keep', help="Write the synthetic run to this directory instead of a temporary one")
+    parser.add_argument('--json', help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        directory = args.keep or tmp_dir
+        os.makedirs(directory, exist_ok=True)
+        rois, true_heights = generate_dataset(directory, args.frames, width, height, args.noise, args.tilt,
+                                              args.lighting_drift, args.seed)
+        report = run_benchmark(directory, rois, true_heights, args.detector, args.animation_frames,
+                               args.renderer)
+        report['resolution'] = [width, height]
+        report['detection_params'] = DETECTION_PARAMS
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,191 @@
+"""
+In-memory index of the images written by the capture scripts, used to keep the Pi's disk from filling up.
+
+manage_disk_usage used to call shutil.disk_usage after every capture and, once over the threshold,
+list and stat the whole image directory and re-check the disk after every single deletion. The index
+is built once at startup, updated whenever an image is written or deleted, and knows the size of
+every image, so freeing space touches only the images that are evicted and checks the disk once per
+batch. Each batch frees margin percent of the disk beyond the excess, so evictions do not happen on
+every capture. Between evictions the disk is only checked again once the images written since the last check
+could have used up the headroom that was left (or every check_every captures, for other writers).
+
+With downscale set, eviction is tiered: the oldest full-size images are first re-encoded at a lower
+resolution, and images are only deleted, oldest first, when that does not free enough space. The
+newest keep_full images are never downscaled.
+
+Images added with queued=True are waiting in the uploader, which deletes them (and calls discard)
+once they are on the remote. Eviction takes the images that are not queued first, such as those
+left over from an earlier run. When the upload falls so far behind that queued images have to go
+too, they are evicted oldest first and the run prints how many were lost, or, for downscaling,
+uploaded at the lower resolution.
+"""
+
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import cv2
+
+
+class CaptureIndex:
+    def __init__(self, directory, threshold=80, downscale=None, keep_full=100, jpeg_quality=85, check_every=100,
+                 margin=1):
+        self.directory = directory
+        self.threshold = threshold
+        self.downscale = downscale
+        self.keep_full = keep_full
+        self.jpeg_quality = jpeg_quality
+        self.check_every = check_every
+        # Free this many percent of the disk below the threshold, so eviction happens in batches
+        self.margin = margin
+
+        # Oldest first. Downscaled images are older than the full-size ones, apart from queued images
+        # that were passed over and images that could not be re-encoded
+        self.full = OrderedDict()       # path -> size in bytes
+        self.reduced = OrderedDict()    # path -> size in bytes
+        self.queued = set()             # paths the uploader has not confirmed yet
+        # The uploader deletes images from its own thread
+        self.lock = threading.Lock()
+        self.headroom = None
+        self.written_since_check = 0
+        self.captures_since_check = 0
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Index the images already in the directory, once, in capture order.
+        Images left over from an earlier run all count as full size.
+        """
+        with self.lock:
+            self.full.clear()
+            self.reduced.clear()
+            self.queued.clear()
+            if not os.path.isdir(self.directory):
+                return
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".jpg")]
+            for entry in sorted(entries, key=lambda e: e.stat().st_ctime):
+                self.full[entry.path] = entry.stat().st_size
+
+    def add(self, path, queued=False):
+        size = os.path.getsize(path)
+        with self.lock:
+            self.full[path] = size
+            if queued:
+                self.queued.add(path)
+            self.written_since_check += size
+            self.captures_since_check += 1
+
+    def discard(self, path):
+        # Called for images deleted elsewhere, e.g. by the uploader after a push
+        with self.lock:
+            self.full.pop(path, None)
+            self.reduced.pop(path, None)
+            self.queued.discard(path)
+
+    def __len__(self):
+        return len(self.full) + len(self.reduced)
+
+    def bytes_over_threshold(self):
+        total, used, free = shutil.disk_usage(self.directory)
+        self.total = total
+        allowed = total * self.threshold / 100
+        self.headroom = allowed - used
+        self.written_since_check = 0
+        self.captures_since_check = 0
+        return used - allowed
+
+    def manage_disk_usage(self):
+        """
+        Check the disk usage if it could be over the threshold by now and, if it is, free the
+        excess plus margin percent of the disk: by downscaling the oldest images first when
+        downscale is set, then by deleting the oldest images. Returns the number of bytes freed.
+        """
+        if (self.headroom is not None and self.written_since_check < self.headroom
+                and self.captures_since_check < self.check_every):
+            return 0
+        excess = self.bytes_over_threshold()
+        if excess <= 0:
+            return 0
+        excess += self.total * self.margin / 100
+
+        print("Disk usage exceeded threshold. Freeing space from the oldest files...")
+        freed = 0
+        if self.downscale:
+            freed += self._downscale_oldest(excess)
+        if freed < excess:
+            freed += self._delete_oldest(excess - freed)
+        # One check for the whole batch, which also resets the headroom
+        self.bytes_over_threshold()
+        return freed
+
+    def _eviction_order(self, paths):
+        # Called with the lock held: the paths oldest first, the ones the uploader still has to send last
+        return ([path for path in paths if path not in self.queued]
+                + [path for path in paths if path in self.queued])
+
+    def _downscale_oldest(self, excess):
+        freed = 0
+        unsent = 0
+        with self.lock:
+            candidates = self._eviction_order(list(self.full)[:max(0, len(self.full) - self.keep_full)])
+        for path in candidates:
+            if freed >= excess:
+                break
+            with self.lock:
+                # The uploader may have deleted it in the meantime
+                size = self.full.pop(path, None)
+            if size is None:
+                continue
+            frame = cv2.imread(path)
+            if frame is None:
+                continue
+            frame = cv2.resize(frame, None, fx=self.downscale, fy=self.downscale, interpolation=cv2.INTER_AREA)
+            ok, data = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                # Leave the image at full size, still the oldest, for the deletion step
+                with self.lock:
+                    self.full[path] = size
+                    self.full.move_to_end(path, last=False)
+                continue
+            # Replace the file in one step so a half-written image is never left behind
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data.tobytes())
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.reduced[path] = len(data)
+                unsent += path in self.queued
+            freed += size - len(data)
+        if freed:
+            print(f"Downscaled old images, freed {freed / 1e6:.1f} MB")
+        if unsent:
+            print(f"{unsent} of the downscaled images had not been uploaded yet")
+        return freed
+
+    def _delete_oldest(self, excess):
+        freed = 0
+        unsent = 0
+        with self.lock:
+            candidates = self._eviction_order(list(self.reduced) + list(self.full))
+        for path in candidates:
+            if freed >= excess:
+                break
+            with self.lock:
+                size = self.reduced.pop(path, None)
+                if size is None:
+                    size = self.full.pop(path, None)
+                was_queued = path in self.queued
+                self.queued.discard(path)
+            if size is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            print(f"Deleted {path}")
+            freed += size
+            unsent += was_queued
+        if unsent:
+            print(f"Deleted {unsent} images that had not been uploaded yet")
+        return freed
@@ -0,0 +1,70 @@
+"""
+Compare the JPEG decode modes of volume_tracker.py against a full colour decode.
+
+For every mode the script times the decode on its own and the decode plus height
+detection, and reports how far the heights move away from the full decode.
+
+Example:
+    python compare_decode.py --directory images/test_pump_20241014-153240 --r1 225 160 30 240 --r2 295 160 30 240
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from volume_tracker import DECODE_MODES, list_images, measure_image, prepare_output_dirs
+
+
+def compare_decode_modes(directory, rois, modes=('full', 'gray', 'reduced2', 'reduced4')):
+    filenames = list_images(directory)
+    results = {}
+
+    # The debug images are written to a scratch directory so the experiment folder stays untouched
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        container_dirs = prepare_output_dirs(scratch_dir, len(rois))
+
+        for mode in modes:
+            flags, _ = DECODE_MODES[mode]
+            start = time.perf_counter()
+            for filename in filenames:
+                cv2.imread(os.path.join(directory, filename), flags)
+            decode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            heights = [measure_image(directory, filename, rois, container_dirs, decode=mode) for filename in filenames]
+            total_time = time.perf_counter() - start
+
+            results[mode] = {'decode_ms': 1000 * decode_time / len(filenames),
+                             'total_ms': 1000 * total_time / len(filenames),
+                             'heights': np.array(heights, dtype=float)}
+
+    reference = results[modes[0]]['heights']
+    for mode in modes:
+        difference = np.abs(results[mode]['heights'] - reference)
+        results[mode]['mean_abs_error'] = float(difference.mean())
+        results[mode]['within_2px'] = float((difference <= 2).mean())
+    return results
+
+
+def print_comparison(directory, results):
+    print(f"{directory}:")
+    print(f"{'mode':<10}{'decode ms':>11}{'total ms':>10}{'speedup':>9}{'mean |dh| px':>14}{'within 2 px':>13}")
+    reference_ms = next(iter(results.values()))['total_ms']
+    for mode, result in results.items():
+        print(f"{mode:<10}{result['decode_ms']:>11.2f}{result['total_ms']:>10.2f}"
+              f"{reference_ms / result['total_ms']:>8.2f}x{result['mean_abs_error']:>14.2f}"
+              f"{100 * result['within_2px']:>12.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare JPEG decode modes for volume tracking.")
+    parser.add_argument('--directory', required=True, help="Directory containing the images")
+    parser.add_argument('--r1', type=int, nargs=4, required=True, help="ROI 1 coordinates: x y width height")
+    parser.add_argument('--r2', type=int, nargs=4, required=True, help="ROI 2 coordinates: x y width height")
+    args = parser.parse_args()
+
+    print_comparison(args.directory, compare_decode_modes(args.directory, (args.r1, args.r2)))
@@ -0,0 +1,67 @@
+"""
+Compare the vectorised row-profile detector with the contour detector of calculate_height.
+
+Both detectors run over the same grayscale decode. The script reports the time per frame,
+how closely the profile heights agree with the contour heights, and the mean frame-to-frame
+change of each series as a measure of how steady it is.
+
+Example:
+    python compare_detectors.py --directory images/Wenlong_20241015-230404 --r1 80 250 40 330 --r2 262 250 40 330 \
+        --threshold 30 --blur-kernel 55 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from volume_tracker import DETECTION_PARAMS, list_images, measure_images
+
+
+def compare_detectors(directory, rois, params=DETECTION_PARAMS):
+    filenames = list_images(directory)
+    container_dirs = [(None, None)] * len(rois)
+    results = {}
+
+    for detector in ('contour', 'profile'):
+        start = time.perf_counter()
+        heights = np.array(list(measure_images(directory, filenames, rois, container_dirs, decode='gray',
+                                               params=params, detector=detector)), dtype=float)
+        elapsed = time.perf_counter() - start
+        results[detector] = {'ms_per_frame': 1000 * elapsed / len(filenames),
+                             'heights': heights,
+                             'jitter': np.abs(np.diff(heights, axis=0)).mean(axis=0)}
+
+    difference = np.abs(results['profile']['heights'] - results['contour']['heights'])
+    results['agreement'] = {'mean_abs_difference': difference.mean(axis=0),
+                            'median_abs_difference': np.median(difference, axis=0),
+                            'within_3px': (difference <= 3).mean(axis=0)}
+    return results
+
+
+def print_comparison(directory, results):
+    print(f"{directory}:")
+    for detector in ('contour', 'profile'):
+        jitter = ', '.join(f"{j:.1f}" for j in results[detector]['jitter'])
+        print(f"  {detector:<8}{results[detector]['ms_per_frame']:>7.2f} ms/frame, "
+              f"mean frame-to-frame change per ROI: {jitter} px")
+    agreement = results['agreement']
+    for i in range(len(agreement['within_3px'])):
+        print(f"  ROI {i + 1}: mean |dh| {agreement['mean_abs_difference'][i]:.1f} px, "
+              f"median |dh| {agreement['median_abs_difference'][i]:.1f} px, "
+              f"within 3 px {100 * agreement['within_3px'][i]:.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the profile and contour meniscus detectors.")
+    parser.add_argument('--directory', required=True, help="Directory containing the images")
+    parser.add_argument('--r1', type=int, nargs=4, required=True, help="ROI 1 coordinates: x y width height")
+    parser.add_argument('--r2', type=int, nargs=4, required=True, help="ROI 2 coordinates: x y width height")
+    parser.add_argument('--threshold', type=int, default=DETECTION_PARAMS['threshold'],
+                        help="Binary threshold (default: %(default)s)")
+    parser.add_argument('--blur-kernel', type=int, nargs=2, default=DETECTION_PARAMS['blur_kernel'],
+                        help="Gaussian blur kernel width and height (default: %(default)s)")
+    args = parser.parse_args()
+
+    params = dict(DETECTION_PARAMS, threshold=args.threshold, blur_kernel=tuple(args.blur_kernel))
+    print_comparison(args.directory, compare_detectors(args.directory, (args.r1, args.r2), params))
@@ -0,0 +1,230 @@
+"""
+Background git uploader for the capture scripts.
+
+Capturing and uploading used to happen in the same loop: every image was added, committed and
+pushed before the next capture, which takes seconds on a Pi Zero and makes the capture interval
+drift. GitUploader moves all git work to a background thread fed by a queue. Files are committed
+in batches (after batch_size files or batch_seconds, whichever comes first) and pushed; a failed
+push is retried with exponential backoff while capture carries on and new batches are committed
+locally. Local files are only deleted once the push that contains them has succeeded.
+
+The uploader only needs a git working copy with a remote, so it can be tried without a camera
+against a local bare repository:
+
+    python git_uploader.py --frames 40 --interval 0.1 --batch-size 8
+
+This makes a bare "remote" and a clone in a temporary directory, writes fake captures into the
+clone, takes the remote away for a while to exercise the retries, and checks at the end that every
+file reached the remote and was deleted locally.
+"""
+
+import argparse
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+
+
+class GitUploader:
+    def __init__(self, repo_path, remote='origin', branch=None, batch_size=10, batch_seconds=300,
+                 retry_delay=5, max_retry_delay=600, on_delete=None):
+        self.repo_path = os.path.abspath(repo_path)
+        self.remote = remote
+        self.branch = branch or self.git('branch', '--show-current').stdout.strip()
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # Called with the path of every image deleted after a push, e.g. CaptureIndex.discard
+        self.on_delete = on_delete
+
+        self.queue = queue.Queue()
+        self.pending = {}     # path -> delete after push, not committed yet
+        self.unpushed = {}    # path -> delete after push, committed but not pushed yet
+        self.batch_started = None
+        self.next_push = None
+        self.failed_pushes = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def git(self, *args):
+        return subprocess.run(['git', *args], cwd=self.repo_path, capture_output=True, text=True)
+
+    def submit(self, path, delete=True):
+        """
+        Queue a file for upload. Files submitted with delete=False (such as metadata.csv) are
+        committed with every batch they are submitted in but never removed.
+        """
+        self.queue.put((os.path.abspath(path), delete))
+
+    def close(self):
+        # Commit and push whatever is still queued, then stop the thread
+        self.queue.put(None)
+        self.thread.join()
+        if self.unpushed:
+            print(f"Uploader stopped with {len(self.unpushed)} files committed but not pushed")
+
+    def _timeout(self):
+        deadlines = []
+        if self.pending:
+            deadlines.append(self.batch_started + self.batch_seconds)
+        if self.unpushed:
+            deadlines.append(self.next_push)
+        return max(0, min(deadlines) - time.monotonic()) if deadlines else None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self._timeout())
+            except queue.Empty:
+                item = ()
+            if item is None:
+                stopping = True
+            elif item:
+                path, delete = item
+                if not self.pending:
+                    self.batch_started = time.monotonic()
+                self.pending[path] = self.pending.get(path, True) and delete
+
+            now = time.monotonic()
+            # Only the images count towards a batch, not the metadata that goes along with them
+            if self.pending and (stopping or sum(self.pending.values()) >= self.batch_size
+                                 or now - self.batch_started >= self.batch_seconds):
+                self._commit()
+            if self.unpushed and (stopping or now >= self.next_push):
+                self._push()
+
+    def _commit(self):
+        # A file removed before its batch is committed (e.g. evicted to free disk space) would make
+        # git add fail for the whole batch, so it is dropped; it can no longer be uploaded anyway
+        missing = [path for path in self.pending if not os.path.exists(path)]
+        for path in missing:
+            del self.pending[path]
+        if missing:
+            print(f"Skipping {len(missing)} files that were removed before they were committed")
+        if not self.pending:
+            return
+
+        paths = list(self.pending)
+        names = sorted(os.path.basename(p) for p, delete in self.pending.items() if delete)
+        added = self.git('add', '--', *paths)
+        if added.returncode != 0:
+            print(f"git add failed, retrying in {self.batch_seconds} s: {added.stderr.strip()}")
+            self.batch_started = time.monotonic()
+            return
+        staged = self.git('diff', '--cached', '--quiet').returncode != 0
+        # Nothing staged only means the files were committed unchanged before if git tracks all of them
+        if not staged and self.git('ls-files', '--error-unmatch', '--', *paths).returncode != 0:
+            print(f"Files not staged and not tracked by git, retrying in {self.batch_seconds} s")
+            self.batch_started = time.monotonic()
+            return
+        message = f"Add {len(names)} images ({names[0]} to {names[-1]})" if names else "Update metadata"
+        result = self.git('commit', '-m', message) if staged else None
+        if result is not None and result.returncode != 0:
+            print(f"git commit failed, retrying in {self.batch_seconds} s: {result.stderr.strip()}")
+            self.batch_started = time.monotonic()
+            return
+        for path, delete in self.pending.items():
+            self.unpushed[path] = self.unpushed.get(path, True) and delete
+        self.pending = {}
+        if self.next_push is None:
+            self.next_push = time.monotonic()
+
+    def _push(self):
+        result = self.git('push', self.remote, f'HEAD:{self.branch}')
+        if result.returncode != 0:
+            self.failed_pushes += 1
+            delay = min(self.max_retry_delay, self.retry_delay * 2 ** (self.failed_pushes - 1))
+            self.next_push = time.monotonic() + delay
+            print(f"git push failed ({self.failed_pushes} in a row), retrying in {delay:g} s: "
+                  f"{result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''}")
+            return
+
+        deleted = 0
+        for path, delete in self.unpushed.items():
+            if delete and os.path.exists(path):
+                os.remove(path)
+                deleted += 1
+                if self.on_delete is not None:
+                    self.on_delete(path)
+        print(f"Pushed {len(self.unpushed)} files, deleted {deleted} local images")
+        self.unpushed = {}
+        self.failed_pushes = 0
+        self.next_push = None
+
+
+def make_local_remote(directory):
+    """
+    A bare repository and a clone of it under directory, for trying the uploader without a network.
+    Returns (bare_path, clone_path).
+    """
+    bare_path = os.path.join(directory, 'remote.git')
+    clone_path = os.path.join(directory, 'clone')
+    subprocess.run(['git', 'init', '-q', '--bare', bare_path], check=True)
+    subprocess.run(['git', 'clone', '-q', bare_path, clone_path], check=True, stderr=subprocess.DEVNULL)
+    for key, value in (('user.name', 'pi'), ('user.email', 'pi@localhost')):
+        subprocess.run(['git', 'config', key, value], cwd=clone_path, check=True)
+    subprocess.run(['git', 'checkout', '-q', '-b', 'main'], cwd=clone_path, check=True)
+    subprocess.run(['git', 'commit', '-q', '--allow-empty', '-m', 'Start experiment'], cwd=clone_path, check=True)
+    subprocess.run(['git', 'push', '-q', 'origin', 'main'], cwd=clone_path, check=True)
+    return bare_path, clone_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Try the background git uploader against a local bare repository.")
+    parser.add_argument('--frames', type=int, default=40, help="Number of fake captures (default: 40)")
+    parser.add_argument('--interval', type=float, default=0.1, help="Seconds between captures (default: 0.1)")
+    parser.add_argument('--batch-size', type=int, default=8, help="Files per commit (default: 8)")
+    parser.add_argument('--batch-seconds', type=float, default=1.0, help="Longest wait before a commit (default: 1)")
+    parser.add_argument('--outage', type=float, default=1.0,
+                        help="Seconds the remote is unreachable halfway through the run (default: 1)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bare_path, clone_path = make_local_remote(tmp_dir)
+        output_dir = os.path.join(clone_path, 'images', 'demo')
+        os.makedirs(output_dir)
+        metadata_path = os.path.join(output_dir, 'metadata.csv')
+        with open(metadata_path, 'w') as f:
+            f.write("Timestamp,Image Path\n")
+
+        uploader = GitUploader(clone_path, batch_size=args.batch_size, batch_seconds=args.batch_seconds,
+                               retry_delay=0.2, max_retry_delay=1.0)
+        start = time.monotonic()
+        late = []
+        for i in range(args.frames):
+            if i == args.frames // 2 and args.outage:
+                os.rename(bare_path, bare_path + '.offline')
+                outage_end = time.monotonic() + args.outage
+            if os.path.exists(bare_path + '.offline') and time.monotonic() >= outage_end:
+                os.rename(bare_path + '.offline', bare_path)
+
+            name = f"frame{i:05d}.jpg"
+            with open(os.path.join(output_dir, name), 'wb') as f:
+                f.write(os.urandom(2048))
+            with open(metadata_path, 'a') as f:
+                f.write(f"{i},{name}\n")
+            uploader.submit(os.path.join(output_dir, name))
+            uploader.submit(metadata_path, delete=False)
+
+            # Same fixed-rate schedule as the capture loop
+            next_capture = start + (i + 1) * args.interval
+            late.append(max(0.0, time.monotonic() - start - i * args.interval))
+            time.sleep(max(0.0, next_capture - time.monotonic()))
+        if os.path.exists(bare_path + '.offline'):
+            os.rename(bare_path + '.offline', bare_path)
+        uploader.close()
+
+        on_remote = subprocess.run(['git', '--git-dir', bare_path, 'ls-tree', '-r', '--name-only', 'main'],
+                                   capture_output=True, text=True, check=True).stdout.split()
+        remote_images = [p for p in on_remote if p.endswith('.jpg')]
+        local_images = [f for f in os.listdir(output_dir) if f.endswith('.jpg')]
+        print(f"{args.frames} captures in {time.monotonic() - start:.2f} s "
+              f"(longest capture delay {1000 * max(late):.1f} ms)")
+        print(f"{len(remote_images)} images on the remote, {len(local_images)} left locally, "
+              f"metadata on the remote: {'images/demo/metadata.csv' in on_remote}")
+        if len(remote_images) != args.frames or local_images:
+            raise SystemExit("Upload incomplete")
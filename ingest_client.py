@@ -0,0 +1,281 @@
+"""
+Background HTTP uploader for the capture scripts, sending to ingest_server.py instead of git.
+
+IngestUploader has the same interface as GitUploader (submit and close), so pi-camera.py can use
+either (--ingest URL). A background thread keeps one HTTP/1.1 connection to the server open and
+sends every submitted file as it comes:
+- a JPEG goes to /experiments/<name>/frames/<timestamp> and is measured on the server, or, with
+  measure_frames=False (edge mode, where the Pi measures itself), to .../images/<timestamp> and is
+  only stored;
+- volumes.csv (edge mode) is sent as the rows that were added since the last upload;
+- anything else (metadata.csv) is left out, the server names the images by their timestamp.
+A failed request is retried with exponential backoff on a new connection while capture carries on.
+Local images are only deleted once the server has accepted them.
+
+Without --url the whole path runs on localhost: an ingest server is started in this process and a
+number of simulated rigs replay a directory of captured images to it, taking the server away for a
+while to exercise the retries:
+
+    python ingest_client.py --directory images/test_pump_20241014-153240 --config edge_config_example.json --rigs 3
+
+At the end the volumes.csv of every rig is checked against the heights measured directly.
+With --url the images are replayed to a running server instead, as experiment --experiment.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class IngestUploader:
+    def __init__(self, url, experiment, measure_frames=True, retry_delay=5, max_retry_delay=600, timeout=30,
+                 on_delete=None):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = f"{parts.path.rstrip('/')}/experiments/{experiment}"
+        self.measure_frames = measure_frames
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.timeout = timeout
+        # Called with the path of every image deleted after an upload, e.g. CaptureIndex.discard
+        self.on_delete = on_delete
+
+        self.queue = queue.Queue()
+        self.connection = None
+        self.row_offsets = {}   # volumes.csv path -> bytes already sent
+        self.sent = 0
+        self.unsent = 0
+        self.failed_requests = 0
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, path, delete=True):
+        """
+        Queue a file for upload. Images submitted with delete=False are kept after the upload.
+        """
+        self.queue.put((os.path.abspath(path), delete))
+
+    def close(self):
+        # Send whatever is still queued, giving each file one more try if the server is unreachable
+        self.stopping = True
+        self.queue.put(None)
+        self.thread.join()
+        if self.connection is not None:
+            self.connection.close()
+        if self.unsent:
+            print(f"Uploader stopped with {self.unsent} files not sent")
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._send_with_retries(*item)
+
+    def _send_with_retries(self, path, delete):
+        while True:
+            try:
+                self._send(path, delete)
+                self.failed_requests = 0
+                return
+            except (OSError, http.client.HTTPException) as error:
+                # The connection may be half-closed; the next attempt opens a new one
+                self._disconnect()
+                self.failed_requests += 1
+                if self.stopping:
+                    self.unsent += 1
+                    return
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** (self.failed_requests - 1))
+                print(f"Upload of {os.path.basename(path)} failed ({self.failed_requests} in a row), "
+                      f"retrying in {delay:g} s: {error}")
+                time.sleep(delay)
+
+    def _send(self, path, delete):
+        name = os.path.basename(path)
+        if name.endswith('.jpg'):
+            with open(path, 'rb') as f:
+                data = f.read()
+            endpoint = 'frames' if self.measure_frames else 'images'
+            if self._post(f"{self.base_path}/{endpoint}/{name[:-len('.jpg')]}", data, 'image/jpeg'):
+                self.sent += 1
+                if delete and os.path.exists(path):
+                    os.remove(path)
+                    if self.on_delete is not None:
+                        self.on_delete(path)
+        elif name == 'volumes.csv':
+            offset = self.row_offsets.get(path, 0)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            # Only whole rows; a row that is still being written goes with the next upload
+            data = data[:data.rfind(b'\n') + 1]
+            if data and self._post(f"{self.base_path}/rows", data, 'text/csv'):
+                self.sent += 1
+            self.row_offsets[path] = offset + len(data)
+
+    def _post(self, path, data, content_type):
+        """
+        POST data and return whether the server accepted it. Server errors raise, so the request
+        is retried; a rejected request (4xx) would be rejected again and is dropped.
+        """
+        if self.connection is None:
+            self.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+        self.connection.request('POST', path, body=data, headers={'Content-Type': content_type})
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.status >= 500:
+            raise http.client.HTTPException(f"server error {response.status}")
+        if response.status >= 400:
+            print(f"Server rejected {path}: {body.decode(errors='replace')}")
+            return False
+        return True
+
+    def _disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def run_rig(url, experiment, source_dir, filenames, rig_dir, interval, edge=None, audit_every=10):
+    """
+    A simulated rig: copies the images into rig_dir at a fixed rate, as the camera would write
+    them, and uploads them. With edge settings it measures each frame itself, uploads volumes.csv
+    and only every audit_every-th image. Returns the capture delays in seconds.
+    """
+    from volume_tracker import container_volumes, format_result_row, measure_frame, results_header
+    import cv2
+
+    uploader = IngestUploader(url, experiment, measure_frames=edge is None, retry_delay=0.1, max_retry_delay=0.5)
+    volumes_path = os.path.join(rig_dir, 'volumes.csv')
+    if edge is not None:
+        with open(volumes_path, 'w') as f:
+            f.write(results_header(len(edge['rois'])))
+
+    start = time.monotonic()
+    late = []
+    for i, filename in enumerate(filenames):
+        image_path = os.path.join(rig_dir, filename)
+        if edge is not None:
+            heights = measure_frame(cv2.imread(os.path.join(source_dir, filename)), edge['rois'], edge['params'],
+                                    edge['detector'])
+            with open(volumes_path, 'a') as f:
+                f.write(format_result_row(time.strptime(filename[:-4], "%Y%m%d-%H%M%S"),
+                                          container_volumes(heights, edge['tables']), heights))
+            uploader.submit(volumes_path, delete=False)
+        if edge is None or i % audit_every == 0:
+            shutil.copyfile(os.path.join(source_dir, filename), image_path)
+            uploader.submit(image_path)
+
+        # Same fixed-rate schedule as the capture loop
+        late.append(max(0.0, time.monotonic() - start - i * interval))
+        time.sleep(max(0.0, start + (i + 1) * interval - time.monotonic()))
+    uploader.close()
+    return late
+
+
+def read_rows(volumes_path):
+    with open(volumes_path, 'r') as f:
+        return [line for line in f if line.strip() and not line.startswith('Timestamp')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send captured images to an ingest server, or try the whole "
+                                                 "ingest path on localhost with simulated rigs.")
+    parser.add_argument('--directory', required=True, help="Directory of captured images to replay")
+    parser.add_argument('--url', help="Ingest server to send to (default: start one on localhost)")
+    parser.add_argument('--experiment', default='replay', help="Experiment name when sending to --url")
+    parser.add_argument('--config', help="Measurement config for the local server and the edge rigs")
+    parser.add_argument('--rigs', type=int, default=3, help="Simulated rigs sending frames (default: 3)")
+    parser.add_argument('--edge-rigs', type=int, default=1,
+                        help="Simulated rigs measuring themselves and sending rows (default: 1)")
+    parser.add_argument('--interval', type=float, default=0.05, help="Seconds between captures (default: 0.05)")
+    parser.add_argument('--workers', type=int, default=2, help="Worker processes of the local server (default: 2)")
+    parser.add_argument('--outage', type=float, default=1.0,
+                        help="Seconds the local server is down halfway through the run (default: 1)")
+    args = parser.parse_args()
+
+    from volume_tracker import list_images
+
+    filenames = list_images(args.directory)
+    if args.url:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for filename in filenames:
+                shutil.copyfile(os.path.join(args.directory, filename), os.path.join(tmp_dir, filename))
+            uploader = IngestUploader(args.url, args.experiment)
+            for filename in filenames:
+                uploader.submit(os.path.join(tmp_dir, filename))
+            uploader.close()
+        print(f"Sent {uploader.sent} of {len(filenames)} images to {args.url}")
+        raise SystemExit(0)
+
+    import cv2
+    from ingest_server import start_server
+    from volume_tracker import measure_frame, read_measurement_config
+
+    if not args.config:
+        parser.error("--config is needed for the local server")
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    edge = read_measurement_config(args.config)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, 'server')
+        server = start_server('127.0.0.1', 0, data_dir, config, args.workers)
+        port = server.server_port
+        url = f"http://127.0.0.1:{port}"
+
+        rigs = [(f"rig{i + 1}", None) for i in range(args.rigs)]
+        rigs += [(f"edge{i + 1}", edge) for i in range(args.edge_rigs)]
+        results = {}
+        threads = []
+        for name, rig_edge in rigs:
+            rig_dir = os.path.join(tmp_dir, name)
+            os.makedirs(rig_dir)
+            thread = threading.Thread(target=lambda n=name, d=rig_dir, e=rig_edge: results.__setitem__(
+                n, run_rig(url, n, args.directory, filenames, d, args.interval, e)))
+            threads.append(thread)
+
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        if args.outage:
+            time.sleep(len(filenames) * args.interval / 2)
+            server.close()
+            print(f"Server down for {args.outage:g} s")
+            time.sleep(args.outage)
+            server = start_server('127.0.0.1', port, data_dir, config, args.workers)
+        for thread in threads:
+            thread.join()
+        server.close()
+        elapsed = time.monotonic() - start
+
+        # The frames the server measured have to match measuring them directly
+        expected = [measure_frame(cv2.imread(os.path.join(args.directory, f)), edge['rois'], edge['params'],
+                                  edge['detector']) for f in filenames]
+        expected_rows = [tuple(round(float(h), 2) for h in heights) for heights in expected]
+        complete = True
+        for name, rig_edge in rigs:
+            rows = read_rows(os.path.join(data_dir, name, 'volumes.csv'))
+            heights = [tuple(float(v) for v in row.split(',')[1:1 + len(edge['rois'])]) for row in rows]
+            images = [f for f in os.listdir(os.path.join(data_dir, name)) if f.endswith('.jpg')]
+            left = [f for f in os.listdir(os.path.join(tmp_dir, name)) if f.endswith('.jpg')]
+            ok = heights == expected_rows and not left
+            complete = complete and ok
+            print(f"{name}: {len(rows)} rows, heights {'match' if heights == expected_rows else 'differ'}, "
+                  f"{len(images)} images on the server, {len(left)} left on the rig, "
+                  f"longest capture delay {1000 * max(results[name]):.1f} ms")
+        frames = args.rigs * len(filenames)
+        print(f"{frames} frames from {args.rigs} rigs and {args.edge_rigs * len(filenames)} rows from "
+              f"{args.edge_rigs} edge rigs in {elapsed:.2f} s")
+        if not complete:
+            raise SystemExit("Ingest incomplete")
@@ -0,0 +1,294 @@
+"""
+HTTP ingest server for the capture rigs, as an alternative to git as the image transport.
+
+Committing every frame to git makes the repository grow without bound and sends all rigs through
+one remote. Instead, each Pi can POST its frames (or, in edge mode, its volumes.csv rows) to this
+server over a persistent HTTP/1.1 connection (ingest_client.py). Every connection is served by
+its own thread. The thread only stores the frame and queues it; the measurement itself runs in a
+pool of worker processes with measure_frame, the same pipeline as edge mode. The results of every
+experiment go to <data dir>/<experiment>/volumes.csv, in the same format as volume_tracker.py,
+in the order the frames arrived.
+
+Endpoints (experiment names may contain letters, digits, '-', '_' and '.', but not start with '.'):
+    POST /experiments/<name>/frames/<YYYYmmdd-HHMMSS>   a JPEG, measured by the worker pool
+    POST /experiments/<name>/images/<YYYYmmdd-HHMMSS>   a JPEG that is only stored (edge mode audit frames)
+    POST /experiments/<name>/rows                       volumes.csv rows measured on the Pi, appended as they are
+    GET  /experiments/<name>/volumes.csv                the results so far
+    GET  /status                                        frames received, measured and failed per experiment
+
+The config has the same keys as the edge mode config (edge_config_example.json) and applies to
+every experiment. Settings for one experiment can be changed under "experiments":
+    {"rois": [...], "calibration": [...], "experiments": {"rig2": {"rois": [...]}}}
+Experiments that only send rows need no config.
+
+Example:
+    python ingest_server.py --config edge_config_example.json --data-dir ingest --port 8080 --workers 4
+
+ingest_client.py runs the whole path on localhost with simulated rigs.
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+from volume_tracker import container_volumes, format_result_row, measure_frame, measurement_settings, results_header
+
+# No leading dot, so '.' and '..' can never name an experiment directory
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]*$')
+TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+
+
+def measure_jpeg(data, rois, params, detector):
+    # Runs in a worker process: decode the posted JPEG and measure it the way edge mode does
+    frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ValueError("not a decodable image")
+    return measure_frame(frame, rois, params, detector)
+
+
+class Experiment:
+    """
+    The results of one experiment. The pool measures frames in any order; their rows are written
+    to volumes.csv in the order the frames arrived, as soon as every earlier frame is done.
+    """
+
+    def __init__(self, directory, settings=None):
+        self.directory = directory
+        self.settings = settings
+        self.volumes_path = os.path.join(directory, 'volumes.csv')
+        self.lock = threading.Lock()
+        self.received = 0
+        self.measured = 0
+        self.failed = 0
+        self.rows = 0
+        self.next_to_write = 0
+        self.done = {}      # frame number -> row, or None for a frame that could not be measured
+        os.makedirs(directory, exist_ok=True)
+
+    def receive_frame(self):
+        # Frame numbers follow the order of arrival
+        with self.lock:
+            number = self.received
+            self.received += 1
+        return number
+
+    def finish_frame(self, number, timestamp, heights):
+        row = None
+        if heights is not None:
+            volumes = container_volumes(heights, self.settings['tables'])
+            row = format_result_row(time.strptime(timestamp, TIMESTAMP_FORMAT), volumes, heights)
+
+        with self.lock:
+            if row is None:
+                self.failed += 1
+            else:
+                self.measured += 1
+            self.done[number] = row
+            rows = []
+            while self.next_to_write in self.done:
+                row = self.done.pop(self.next_to_write)
+                if row is not None:
+                    rows.append(row)
+                self.next_to_write += 1
+            if rows:
+                self._append_rows(rows, len(self.settings['rois']))
+
+    def frame_failed(self, number, timestamp, error):
+        print(f"{os.path.basename(self.directory)}: could not measure {timestamp}: {error}")
+        self.finish_frame(number, timestamp, None)
+
+    def receive_rows(self, text):
+        rows = [line + '\n' for line in text.splitlines() if line.strip() and not line.startswith('Timestamp')]
+        if rows:
+            # Timestamp, a height and a volume per container, then the total
+            n_containers = (len(rows[0].split(',')) - 2) // 2
+            with self.lock:
+                self._append_rows(rows, n_containers)
+        return len(rows)
+
+    def _append_rows(self, rows, n_containers):
+        # Called with the lock held
+        new_file = not os.path.exists(self.volumes_path)
+        with open(self.volumes_path, 'a') as f:
+            if new_file:
+                f.write(results_header(n_containers))
+            f.writelines(rows)
+        self.rows += len(rows)
+
+    def status(self):
+        with self.lock:
+            return {'received': self.received, 'measured': self.measured, 'failed': self.failed,
+                    'pending': self.received - self.measured - self.failed, 'rows': self.rows}
+
+
+class IngestServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, data_dir, config=None, workers=2, keep_images=True, verbose=False):
+        super().__init__(address, IngestHandler)
+        self.data_dir = data_dir
+        self.config = config or {}
+        self.keep_images = keep_images
+        self.verbose = verbose
+        self.experiments = {}
+        self.lock = threading.Lock()
+        self.closing = False
+        self.pool = Pool(workers)
+
+    def experiment(self, name):
+        with self.lock:
+            if name not in self.experiments:
+                self.experiments[name] = Experiment(self.experiment_directory(name), self.experiment_settings(name))
+            return self.experiments[name]
+
+    def experiment_directory(self, name):
+        """
+        The directory of experiment name, or None for a name that is not allowed or that would
+        lead out of the data directory.
+        """
+        if not NAME_PATTERN.match(name):
+            return None
+        data_dir = os.path.realpath(self.data_dir)
+        directory = os.path.realpath(os.path.join(data_dir, name))
+        return directory if os.path.dirname(directory) == data_dir else None
+
+    def experiment_settings(self, name):
+        config = {key: value for key, value in self.config.items() if key != 'experiments'}
+        config.update(self.config.get('experiments', {}).get(name, {}))
+        return measurement_settings(config) if 'rois' in config else None
+
+    def store_image(self, experiment, timestamp, data):
+        with open(os.path.join(experiment.directory, f"{timestamp}.jpg"), 'wb') as f:
+            f.write(data)
+
+    def submit_frame(self, experiment, timestamp, data):
+        number = experiment.receive_frame()
+        if self.keep_images:
+            self.store_image(experiment, timestamp, data)
+        settings = experiment.settings
+        self.pool.apply_async(measure_jpeg, (data, settings['rois'], settings['params'], settings['detector']),
+                              callback=partial(experiment.finish_frame, number, timestamp),
+                              error_callback=partial(experiment.frame_failed, number, timestamp))
+        return number
+
+    def status(self):
+        with self.lock:
+            experiments = dict(self.experiments)
+        return {name: experiment.status() for name, experiment in sorted(experiments.items())}
+
+    def close(self):
+        # Stop accepting requests (open connections get 503 and retry later), then let the pool
+        # finish and write every frame it was given
+        self.closing = True
+        self.shutdown()
+        self.pool.close()
+        self.pool.join()
+        self.server_close()
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection of every rig open between requests
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        # Always read the body, so the connection stays usable after an error reply
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.closing:
+            self.close_connection = True
+            return self.reply(503, {'error': "shutting down"})
+        parts = self.path.strip('/').split('/')
+        if len(parts) < 3 or parts[0] != 'experiments' or self.server.experiment_directory(parts[1]) is None:
+            return self.reply(404, {'error': f"unknown path {self.path}"})
+        name = parts[1]
+
+        if len(parts) == 4 and parts[2] in ('frames', 'images'):
+            timestamp = parts[3]
+            try:
+                time.strptime(timestamp, TIMESTAMP_FORMAT)
+            except ValueError:
+                return self.reply(400, {'error': f"frame timestamps look like 20241014-153242, not {timestamp}"})
+            experiment = self.server.experiment(name)
+            if parts[2] == 'images':
+                self.server.store_image(experiment, timestamp, body)
+                return self.reply(201, {'experiment': name})
+            if experiment.settings is None:
+                return self.reply(409, {'error': f"no ROIs configured for experiment {name}"})
+            number = self.server.submit_frame(experiment, timestamp, body)
+            return self.reply(202, {'experiment': name, 'frame': number})
+
+        if len(parts) == 3 and parts[2] == 'rows':
+            rows = self.server.experiment(name).receive_rows(body.decode())
+            return self.reply(201, {'experiment': name, 'rows': rows})
+        return self.reply(404, {'error': f"unknown path {self.path}"})
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['status']:
+            return self.reply(200, self.server.status())
+        if (len(parts) == 3 and parts[0] == 'experiments' and parts[2] == 'volumes.csv'
+                and self.server.experiment_directory(parts[1]) is not None):
+            path = os.path.join(self.server.experiment_directory(parts[1]), 'volumes.csv')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return self.reply(200, f.read(), 'text/csv')
+        return self.reply(404, {'error': f"unknown path {self.path}"})
+
+    def reply(self, code, payload, content_type='application/json'):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def start_server(host, port, data_dir, config=None, workers=2, keep_images=True, verbose=False):
+    """
+    An IngestServer serving from a background thread; port 0 picks a free port (see server.server_port).
+    """
+    server = IngestServer((host, port), data_dir, config, workers, keep_images, verbose)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Receive frames and measurement rows from the capture rigs over HTTP.")
+    parser.add_argument('--config', help="Measurement config (ROIs, calibration, detector) in the edge mode format")
+    parser.add_argument('--data-dir', default='ingest', help="Directory for the experiments (default: ingest)")
+    parser.add_argument('--host', default='0.0.0.0', help="Address to listen on (default: all interfaces)")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on (default: 8080)")
+    parser.add_argument('--workers', type=int, default=2, help="Worker processes measuring frames (default: 2)")
+    parser.add_argument('--no-images', action='store_true', help="Measure the frames without keeping them")
+    parser.add_argument('--verbose', action='store_true', help="Log every request")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    server = IngestServer((args.host, args.port), args.data_dir, config, args.workers, not args.no_images,
+                          args.verbose)
+    print(f"Receiving on port {server.server_port}, writing to {args.data_dir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # serve_forever has returned, so only the pool is left to finish
+        server.closing = True
+        server.pool.close()
+        server.pool.join()
+        server.server_close()
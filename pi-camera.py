@@ -11,14 +11,18 @@ Features:
 - Saves images and metadata to a specified directory.
 - Automatically creates a metadata CSV file and a README file in the output directory.
 - Uses the current Git branch to commit and push images and metadata to the repository.
-- Deletes local images after successful upload to GitHub to manage disk space.
-- Includes a function to check disk usage and delete the oldest files if the usage exceeds a specified threshold.
+  Uploading runs in the background (git_uploader.py): images are committed in batches and
+  pushed with retries, so a slow or failed push never delays the next capture.
+  With --ingest, images (or, in edge mode, the measurement rows) are sent to an ingest server
+  (ingest_server.py) over HTTP instead, and git is not used at all.
+- Deletes local images after a successful push to GitHub to manage disk space.
+- Keeps an index of the captured images (capture_index.py) and frees space from the oldest images
+  if the disk usage exceeds a specified threshold, optionally by downscaling them before deleting any.
 
 Dependencies:
 - picamera2
 - OpenCV
 - Git
-- shutil
 
 To use on a Raspberry pi via ssh
 1. Log into SSH of the raspberry pi
@@ -38,31 +42,31 @@ import os
 import subprocess
 import cv2
 from picamera2 import Picamera2
-import shutil
 import argparse
+from capture_index import CaptureIndex
+from git_uploader import GitUploader
+from ingest_client import IngestUploader
 
-# Function to check disk usage and delete oldest files if necessary
-def manage_disk_usage(directory, threshold=80):
-    total, used, free = shutil.disk_usage("/")
-    used_percentage = (used / total) * 100
-
-    if used_percentage > threshold:
-        print("Disk usage exceeded threshold. Deleting oldest files...")
-        files = sorted(
-            (os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".jpg")),
-            key=os.path.getctime
-        )
-        while used_percentage > threshold and files:
-            oldest_file = files.pop(0)
-            os.remove(oldest_file)
-            print(f"Deleted {oldest_file}")
-            total, used, free = shutil.disk_usage("/")
-            used_percentage = (used / total) * 100
 
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description="Capture images at specified intervals using the Picamera2.")
 parser.add_argument("experiment_name", type=str, help="Name of the experiment")
 parser.add_argument("image_interval", type=int, help="Image capture interval in seconds")
+parser.add_argument("--disk-threshold", type=float, default=80,
+                    help="Free space from the oldest images above this disk usage in percent (default: 80)")
+parser.add_argument("--downscale", type=float,
+                    help="Downscale the oldest images by this factor (e.g. 0.5) before deleting any")
+parser.add_argument("--keep-full", type=int, default=100,
+                    help="Number of newest images that are never downscaled (default: 100)")
+parser.add_argument("--batch-size", type=int, default=10, help="Images per git commit (default: 10)")
+parser.add_argument("--batch-seconds", type=float, default=300,
+                    help="Commit a partial batch after this many seconds (default: 300)")
+parser.add_argument("--remote", default="origin", help="Git remote to push to (default: origin)")
+parser.add_argument("--edge", metavar="CONFIG",
+                    help="Edge mode: measure the volumes on the Pi with the ROIs and calibration in this JSON "
+                         "config, and upload only volumes.csv and every Nth frame for auditing")
+parser.add_argument("--ingest", metavar="URL",
+                    help="Send to this ingest server (e.g. http://server:8080) instead of pushing to git")
 args = parser.parse_args()
 
 experiment_name = args.experiment_name
@@ -94,44 +98,84 @@ if not os.path.exists(readme_path):
         f.write("## Metadata\n\n")
         f.write("Additional metadata about the images can be found in `metadata.csv`.\n")
 
-# Use the existing Git repository
-repo_path = os.path.dirname(os.path.abspath(__file__))  # Path of the current code
-
-# Ensure the script uses the same branch
-current_branch = subprocess.run(['git', 'branch', '--show-current'], cwd=repo_path, capture_output=True, text=True).stdout.strip()
-subprocess.run(['git', 'checkout', current_branch], cwd=repo_path)
+# In edge mode the measurement rows go to volumes.csv, in the same format as volume_tracker.py
+edge = None
+if args.edge:
+    from volume_tracker import (container_volumes, format_result_row, measure_frame, read_measurement_config,
+                                results_header)
+
+    edge = read_measurement_config(args.edge)
+    volumes_path = os.path.join(output_dir, 'volumes.csv')
+    if not os.path.exists(volumes_path):
+        with open(volumes_path, 'w') as f:
+            f.write(results_header(len(edge['rois'])))
+
+# Index of the captured images, built once and updated on every write and delete
+capture_index = CaptureIndex(output_dir, args.disk_threshold, args.downscale, args.keep_full)
+
+if args.ingest:
+    # Images are sent by a background thread, and deleted locally once the server has them
+    uploader = IngestUploader(args.ingest, os.path.basename(output_dir), measure_frames=edge is None,
+                              on_delete=capture_index.discard)
+else:
+    # Use the existing Git repository
+    repo_path = os.path.dirname(os.path.abspath(__file__))  # Path of the current code
+
+    # Ensure the script uses the same branch
+    current_branch = subprocess.run(['git', 'branch', '--show-current'], cwd=repo_path, capture_output=True, text=True).stdout.strip()
+    subprocess.run(['git', 'checkout', current_branch], cwd=repo_path)
+
+    # Images are committed and pushed by a background thread, and deleted locally once pushed
+    uploader = GitUploader(repo_path, args.remote, current_branch, args.batch_size, args.batch_seconds,
+                           on_delete=capture_index.discard)
 
 # Capture images at specified intervals and upload to Git
 interval = image_interval
-while True:
-    timestamp = time.strftime("%Y%m%d-%H%M%S")
-    image_path = os.path.join(output_dir, f"{timestamp}.jpg")
-
-    # Capture image
-    frame = picam2.capture_array()
-    # Optional clockwise rotation
-    frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
-    cv2.imwrite(image_path, frame)
-
-    # Update metadata
-    with open(metadata_path, 'a') as f:
-        f.write(f"{timestamp},{image_path}\n")
-
-    # Add, commit, and push the new image and metadata to the Git repository
-    subprocess.run(['git', 'add', image_path, metadata_path], cwd=repo_path)
-    subprocess.run(['git', 'commit', '-m', f"Add image and metadata for {timestamp}"], cwd=repo_path)
-    subprocess.run(['git', 'push'], cwd=repo_path)
-
-    print(f"Captured and uploaded image at {timestamp}")
-
-    # Delete the image from the local storage after pushing to GitHub
-    os.remove(image_path)
-    print(f"Deleted local image at {image_path}")
-
-    # Manage disk usage
-    manage_disk_usage(output_dir)
-
-    time.sleep(interval)
-
-picam2.stop()
-print("Camera stopped.")
\ No newline at end of file
+next_capture = time.monotonic()
+capture_count = 0
+try:
+    while True:
+        capture_time = time.localtime()
+        timestamp = time.strftime("%Y%m%d-%H%M%S", capture_time)
+        image_path = os.path.join(output_dir, f"{timestamp}.jpg")
+
+        # Capture image
+        frame = picam2.capture_array()
+        # Optional clockwise rotation
+        frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+        capture_count += 1
+
+        if edge is not None:
+            # Measure straight from the captured array; only every Nth frame is kept as a JPEG
+            heights = measure_frame(frame, edge['rois'], edge['params'], edge['detector'])
+            volumes = container_volumes(heights, edge['tables'])
+            with open(volumes_path, 'a') as f:
+                f.write(format_result_row(capture_time, volumes, heights))
+            uploader.submit(volumes_path, delete=False)
+            print(f"Measured {', '.join(f'{v:.2f}' for v in volumes)} mL at {timestamp}")
+
+        if edge is None or (capture_count - 1) % edge['audit_every'] == 0:
+            cv2.imwrite(image_path, frame)
+            # Queued until the uploader has sent it, so eviction takes other images first
+            capture_index.add(image_path, queued=True)
+
+            # Update metadata
+            with open(metadata_path, 'a') as f:
+                f.write(f"{timestamp},{image_path}\n")
+
+            # Queue the new image and metadata for the Git repository
+            uploader.submit(image_path)
+            uploader.submit(metadata_path, delete=False)
+            print(f"Captured image at {timestamp}")
+
+        # Manage disk usage
+        capture_index.manage_disk_usage()
+
+        # Sleep until the next slot rather than a full interval, so the capture rate does not drift
+        # (after a capture that overran its slot, the schedule restarts from now instead of bursting)
+        next_capture = max(next_capture + interval, time.monotonic())
+        time.sleep(max(0, next_capture - time.monotonic()))
+finally:
+    picam2.stop()
+    print("Camera stopped.")
+    uploader.close()
\ No newline at end of file
@@ -0,0 +1,128 @@
+"""
+Opt-in per-stage timing for the volume tracker (the --profile option).
+
+The pipeline is instrumented at the stages where a run can lose its time: the JPEG decode,
+the threshold/blur, Canny and contour steps of calculate_height, the debug image writes, the
+outlier cleaning, save_results and the animation. Every stage records the wall time of each
+call, so the report gives call counts, totals and latency percentiles per stage; the 'frame'
+stage is the latency of one image through decode and detection.
+
+Profiling is off unless PROFILER.enable() is called. A disabled stage is a single attribute
+check, so the instrumentation can stay in the measurement loop. Worker processes have their
+own PROFILER; the pool calls go through profiled(), which returns the worker's samples with
+the result so the parent can merge them.
+"""
+
+import contextlib
+import functools
+import json
+import sys
+import time
+
+import numpy as np
+
+_NOT_PROFILING = contextlib.nullcontext()
+
+
+class _StageTimer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+
+
+class StageProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.samples = {}     # stage -> list of call durations in seconds
+        self.started = None
+
+    def enable(self):
+        self.enabled = True
+        if self.started is None:
+            self.started = time.perf_counter()
+
+    def stage(self, name):
+        """
+        Context manager timing one call of a stage: with PROFILER.stage('imread'): ...
+        """
+        if not self.enabled:
+            return _NOT_PROFILING
+        return _StageTimer(self, name)
+
+    def timed(self, name=None):
+        """
+        Decorator that times every call of a function as a stage, named after the function by default.
+        """
+        def decorate(function):
+            stage_name = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _StageTimer(self, stage_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def record(self, name, seconds):
+        # list.append is atomic, so the debug image writer thread can record too
+        self.samples.setdefault(name, []).append(seconds)
+
+    def take(self):
+        # Hand the samples over (from a worker to the parent process) and start afresh
+        samples, self.samples = self.samples, {}
+        return samples
+
+    def merge(self, samples):
+        for name, durations in samples.items():
+            self.samples.setdefault(name, []).extend(durations)
+
+    def report(self):
+        wall = time.perf_counter() - self.started if self.started is not None else 0.0
+        stages = {}
+        for name, durations in sorted(self.samples.items(), key=lambda item: -sum(item[1])):
+            milliseconds = 1000 * np.array(durations)
+            p50, p90, p99 = np.percentile(milliseconds, (50, 90, 99))
+            stages[name] = {'calls': len(durations),
+                            'total_seconds': float(milliseconds.sum() / 1000),
+                            'mean_ms': float(milliseconds.mean()),
+                            'p50_ms': float(p50), 'p90_ms': float(p90), 'p99_ms': float(p99),
+                            'max_ms': float(milliseconds.max())}
+        return {'command': sys.argv, 'wall_seconds': wall, 'stages': stages}
+
+    def write_report(self, report_file):
+        """
+        Write the report as JSON and print a summary. Stages nest (process_images contains
+        frame, which contains imread and the detection steps) and worker processes run in
+        parallel, so the totals do not add up to the wall time.
+        """
+        report = self.report()
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        print(f"Profile ({report['wall_seconds']:.2f} s wall time) written to {report_file}")
+        print(f"{'stage':<32}{'calls':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for name, stage in report['stages'].items():
+            print(f"{name:<32}{stage['calls']:>8}{stage['total_seconds']:>10.3f}{stage['mean_ms']:>10.2f}"
+                  f"{stage['p50_ms']:>10.2f}{stage['p99_ms']:>10.2f}")
+        return report
+
+
+PROFILER = StageProfiler()
+
+
+def profiled(function, *args, **kwargs):
+    """
+    Run function in a worker process with profiling on and return (result, samples),
+    for pool.imap(partial(profiled, function, ...)). The parent merges the samples.
+    """
+    PROFILER.enable()
+    result = function(*args, **kwargs)
+    return result, PROFILER.take()
@@ -0,0 +1,215 @@
+"""
+Sweep the detection parameters of calculate_height and write the best set to a config.
+
+volume_tracker.py and animation_cluster.py were tuned by hand to different thresholds, blur
+kernels and aspect-ratio cut-offs. This script tries a grid of parameter sets (or a random sample
+of it) on an experiment and scores each one. The images are decoded once, into the crop cache of
+the experiment (see extract_crops), and every parameter set is measured from the mapped crops,
+one set per worker process.
+
+Each set is scored, per ROI and then averaged, on:
+- missed: the fraction of frames without a meniscus (height 0)
+- outliers: the fraction of the other frames that the rolling Hampel filter (StreamingOutlierFilter)
+  rejects, with deviations in pixels
+- jitter: the mean frame-to-frame change of the height series after the outliers are replaced, in pixels
+- label error: with --labels, the mean absolute difference from hand-measured heights, in pixels
+The score is jitter + label error + --penalty * (missed + outliers), lower is better. Without labels
+a set that locks onto a fixed edge (the rack, the top of the ROI) looks perfectly steady, so label
+a few frames across the run when possible. The labels are a CSV with a Filename column and one
+HeightN column per ROI, in pixels from the bottom of the ROI like the Height columns of volumes.csv.
+
+The best set is written as a measurement config (see edge_config_example.json), which
+volume_tracker.py and animation_cluster.py read with --detection-config, and pi-camera.py --edge
+and ingest_server.py read as a whole when it has the calibration too.
+
+Example:
+    python tune_detection.py --directory images/Wenlong_20241015-230404 --roi 80 250 40 330 --roi 262 250 40 330 \
+        --thresholds 20 30 50 85 --blur-widths 35 55 75 --workers 4 --output wenlong_detection.json
+"""
+
+import argparse
+import csv
+import itertools
+import json
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from volume_tracker import (DECODE_MODES, DETECTION_PARAMS, DETECTORS, StreamingOutlierFilter, extract_crops,
+                            measure_images, resolve_decode_mode)
+
+
+def parameter_grid(thresholds, blur_widths, blur_heights, aspect_ratios):
+    return [{'threshold': int(threshold), 'blur_kernel': (int(width), int(height)),
+             'min_aspect_ratio': float(aspect_ratio)}
+            for threshold, width, height, aspect_ratio
+            in itertools.product(thresholds, blur_widths, blur_heights, aspect_ratios)]
+
+
+def random_parameter_sets(n_sets, thresholds, blur_widths, blur_heights, aspect_ratios, seed=0):
+    """
+    n_sets parameter sets drawn uniformly between the smallest and largest value of each list.
+    Gaussian kernel sizes are rounded to odd numbers.
+    """
+    rng = np.random.default_rng(seed)
+
+    def odd(values):
+        return int(rng.integers(min(values), max(values) + 1)) | 1
+
+    return [{'threshold': int(rng.integers(min(thresholds), max(thresholds) + 1)),
+             'blur_kernel': (odd(blur_widths), odd(blur_heights)),
+             'min_aspect_ratio': round(float(rng.uniform(min(aspect_ratios), max(aspect_ratios))), 2)}
+            for _ in range(n_sets)]
+
+
+def read_labels(labels_file):
+    # {filename: (height per ROI)}, from a CSV with a Filename column and Height1, Height2, ...
+    with open(labels_file, 'r', newline='') as f:
+        rows = list(csv.DictReader(f))
+    columns = sorted((c for c in rows[0] if c.startswith('Height')), key=lambda c: int(c[len('Height'):]))
+    return {row['Filename']: tuple(float(row[c]) for c in columns) for row in rows}
+
+
+def score_heights(heights, labelled=None, penalty=100.0, window=7, n_sigmas=3.0, min_deviation=2.0):
+    """
+    Score a (frames, ROIs) array of heights, see the module docstring. labelled is a pair of
+    (frame positions, labelled heights), or None.
+    """
+    missed = (heights == 0).mean(axis=0)
+    outliers = np.zeros(heights.shape[1])
+    jitter = np.zeros(heights.shape[1])
+    for i, series in enumerate(heights.T):
+        # Frames without a meniscus are replaced too, but only counted as missed
+        outlier_filter = StreamingOutlierFilter(window, n_sigmas, max_volume=np.inf, min_deviation=min_deviation)
+        filtered = [outlier_filter.update(np.nan if h == 0 else float(h)) for h in series]
+        cleaned = np.array([value for value, _ in filtered])
+        flagged = np.array([outlier for _, outlier in filtered]) & (series > 0)
+        outliers[i] = flagged.sum() / max(1, (series > 0).sum())
+        steps = np.abs(np.diff(cleaned))
+        jitter[i] = np.nanmean(steps) if np.isfinite(steps).any() else 0.0
+
+    scores = {'missed': float(missed.mean()), 'outliers': float(outliers.mean()), 'jitter_px': float(jitter.mean())}
+    score = scores['jitter_px'] + penalty * (scores['missed'] + scores['outliers'])
+    if labelled is not None:
+        positions, label_heights = labelled
+        scores['label_error_px'] = float(np.abs(heights[positions] - label_heights).mean())
+        score += scores['label_error_px']
+    scores['score'] = float(score)
+    return scores
+
+
+def evaluate_parameters(params, directory, crops, rois, detector='contour', labelled=None, penalty=100.0):
+    # Runs in a worker process: measure every frame from the crop cache with one parameter set
+    heights = np.array(list(measure_images(directory, crops.filenames, rois, [(None, None)] * len(rois),
+                                           decode=crops.decode, params=params, detector=detector, crops=crops)),
+                       dtype=float)
+    return dict(score_heights(heights, labelled, penalty), params=params)
+
+
+def sweep_parameters(directory, rois, parameter_sets, detector='contour', decode='full', labels=None, workers=1,
+                     penalty=100.0):
+    """
+    Score every parameter set on the images of directory and return the results, best first.
+    """
+    decode = resolve_decode_mode(decode, rois)
+    crops = extract_crops(directory, rois, decode, workers=workers)
+    labelled = None
+    if labels:
+        known = [(crops.positions[filename], heights) for filename, heights in labels.items()
+                 if filename in crops.positions]
+        if not known:
+            raise ValueError("None of the labelled images are in the directory")
+        positions, label_heights = zip(*known)
+        labelled = (np.array(positions), np.array(label_heights))
+        print(f"{len(known)} labelled images")
+
+    evaluate = partial(evaluate_parameters, directory=directory, crops=crops, rois=rois, detector=detector,
+                       labelled=labelled, penalty=penalty)
+    print(f"Scoring {len(parameter_sets)} parameter sets on {len(crops)} images")
+    if workers <= 1:
+        results = [evaluate(params) for params in parameter_sets]
+    else:
+        with Pool(workers) as pool:
+            results = pool.map(evaluate, parameter_sets)
+    return sorted(results, key=lambda result: result['score'])
+
+
+def print_results(results, n_rows=10):
+    labelled = 'label_error_px' in results[0]
+    print(f"{'threshold':>10}{'blur':>10}{'aspect':>8}{'missed':>9}{'outliers':>10}{'jitter px':>11}"
+          + (f"{'label px':>10}" if labelled else "") + f"{'score':>9}")
+    for result in results[:n_rows]:
+        params = result['params']
+        blur = 'x'.join(str(k) for k in params['blur_kernel'])
+        print(f"{params['threshold']:>10}{blur:>10}{params['min_aspect_ratio']:>8.2f}"
+              f"{100 * result['missed']:>8.1f}%{100 * result['outliers']:>9.1f}%{result['jitter_px']:>11.2f}"
+              + (f"{result['label_error_px']:>10.2f}" if labelled else "") + f"{result['score']:>9.2f}")
+
+
+def write_best_config(output_file, results, rois, detector, calibration=None):
+    best = results[0]
+    config = {'rois': [[int(v) for v in roi] for roi in rois],
+              'detector': detector,
+              'detection_params': dict(best['params'], blur_kernel=list(best['params']['blur_kernel'])),
+              'tuning': {key: value for key, value in best.items() if key != 'params'}}
+    if calibration:
+        config['calibration'] = calibration
+    with open(output_file, 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def write_results_csv(results_file, results):
+    keys = [key for key in results[0] if key != 'params']
+    with open(results_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['threshold', 'blur_width', 'blur_height', 'min_aspect_ratio'] + keys)
+        for result in results:
+            params = result['params']
+            writer.writerow([params['threshold'], *params['blur_kernel'], params['min_aspect_ratio']]
+                            + [result[key] for key in keys])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep the meniscus detection parameters and save the best set.")
+    parser.add_argument('--directory', required=True, help="Directory containing the images")
+    parser.add_argument('--roi', type=int, nargs=4, action='append', required=True,
+                        help="ROI coordinates: x y width height. Repeat once per container")
+    parser.add_argument('--detector', choices=DETECTORS, default='contour', help="Meniscus detector (default: contour)")
+    parser.add_argument('--decode', choices=sorted(DECODE_MODES), default='full',
+                        help="How the JPEGs are decoded into the crop cache (default: full)")
+    parser.add_argument('--thresholds', type=int, nargs='+', default=[20, 30, 50, 70, 85],
+                        help="Binary thresholds to try (default: 20 30 50 70 85)")
+    parser.add_argument('--blur-widths', type=int, nargs='+', default=[35, 55, 75],
+                        help="Gaussian blur kernel widths to try, odd (default: 35 55 75)")
+    parser.add_argument('--blur-heights', type=int, nargs='+', default=[3, 5, 7],
+                        help="Gaussian blur kernel heights to try, odd (default: 3 5 7)")
+    parser.add_argument('--aspect-ratios', type=float, nargs='+', default=[DETECTION_PARAMS['min_aspect_ratio']],
+                        help="Minimum contour aspect ratios to try (default: %(default)s)")
+    parser.add_argument('--random', type=int, metavar='N',
+                        help="Try N random sets between the smallest and largest values above instead of the grid")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for --random (default: 0)")
+    parser.add_argument('--labels', help="CSV of hand-measured heights (Filename, Height1, Height2, ...)")
+    parser.add_argument('--penalty', type=float, default=100.0,
+                        help="Score in pixels for missing the meniscus in, or rejecting, every frame (default: 100)")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes, one parameter set each (default: 1)")
+    parser.add_argument('--calibration', nargs='+',
+                        help="Calibration file(s) to add to the config, making it a complete measurement config")
+    parser.add_argument('--output', default='detection_config.json',
+                        help="Config file for the best set (default: detection_config.json)")
+    parser.add_argument('--results', help="Also write the scores of every set to this CSV file")
+    args = parser.parse_args()
+
+    if any(k % 2 == 0 for k in args.blur_widths + args.blur_heights):
+        parser.error("Gaussian blur kernel sizes have to be odd")
+    lists = (args.thresholds, args.blur_widths, args.blur_heights, args.aspect_ratios)
+    parameter_sets = random_parameter_sets(args.random, *lists, args.seed) if args.random else parameter_grid(*lists)
+    labels = read_labels(args.labels) if args.labels else None
+
+    results = sweep_parameters(args.directory, args.roi, parameter_sets, args.detector, args.decode, labels,
+                               args.workers, args.penalty)
+    print_results(results)
+    write_best_config(args.output, results, args.roi, args.detector, args.calibration)
+    print(f"Best parameters written to {args.output}")
+    if args.results:
+        write_results_csv(args.results, results)
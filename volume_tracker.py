@@ -1,46 +1,262 @@
 import os
+import json
+import queue
+import argparse
+import threading
+import itertools
+import importlib.util
+import io
+import struct
+from collections import deque
 import cv2
 import numpy as np
 import time
+from functools import partial
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import matplotlib.dates as mdates
+import matplotlib.colors as mcolors
 from datetime import datetime
 import pandas as pd
+from PIL import Image
+from stage_profiler import PROFILER, profiled
 
 CREATE_ANIMATIONS = False
 
-def read_calibration(file_path):
+
+# Parameters of the meniscus detection in calculate_height; they are part of the height cache key
+DETECTION_PARAMS = {'threshold': 85, 'blur_kernel': (75, 5), 'min_aspect_ratio': 2.0}
+
+# How cv2.imread decodes each image and the factor by which the result is reduced.
+# The detector only looks at grey levels inside the ROIs, so the colour conversion can
+# be skipped entirely and, for wide enough ROIs, libjpeg can decode at 1/2 or 1/4 scale.
+DECODE_MODES = {'full': (cv2.IMREAD_COLOR, 1),
+                'gray': (cv2.IMREAD_GRAYSCALE, 1),
+                'reduced2': (cv2.IMREAD_REDUCED_GRAYSCALE_2, 2),
+                'reduced4': (cv2.IMREAD_REDUCED_GRAYSCALE_4, 4)}
+
+# Smallest ROI width (in reduced pixels) for which a reduced decode is still used
+MIN_REDUCED_ROI_WIDTH = 8
+
+# Meniscus detectors: 'contour' is calculate_height, 'profile' is the vectorised profile_heights and
+# 'pyramid' is calculate_height on a downscaled ROI, refined at full resolution (pyramid_height)
+DETECTORS = ('contour', 'profile', 'pyramid')
+
+# Frames per batch for the profile detector, and the fraction of the ROI width that has to
+# turn from bright to dark across the meniscus for the profile detector to accept it
+PROFILE_BATCH_SIZE = 64
+PROFILE_MIN_STEP = 0.25
+
+# The pyramid detector downscales each ROI by a power of two until it is less than twice this many rows
+# high, and refines the coarse meniscus in a full-resolution strip of this many coarse rows
+PYRAMID_COARSE_ROWS = 64
+PYRAMID_REFINE_ROWS = 3
+
+# Per-image raw heights are cached in this file inside the image directory
+HEIGHT_CACHE_FILE = "height_cache.json"
+
+# Grayscale ROI crops are cached in this subdirectory of the image directory, next to metadata.csv
+CROP_CACHE_DIR = "roi_crops"
+
+def load_calibration(file_path):
+    """
+    All settings of a calibration file as a dict of "key: value" lines. Lines starting with # are
+    comments. A "points:" line starts a table of "fraction, volume" lines, where fraction is the
+    meniscus height as a fraction of the ROI height (0 at the bottom, 1 at the top).
+    """
+    calibration = {}
+    points = None
     with open(file_path, 'r') as f:
-        lines = f.readlines()
-        shape = lines[0].split(':')[1].strip()
-        min_volume = float(lines[1].split(':')[1].strip())
-        max_volume = float(lines[2].split(':')[1].strip())
-        instructions = lines[3].split(':')[1].strip()
-    return shape, min_volume, max_volume, instructions
-
-def calculate_height(roi, frame, processed_dir, blur_dir, filename):
-    roi_frame = frame[int(roi[1]):int(roi[1] + roi[3]), int(roi[0]):int(roi[0] + roi[2])]
-    gray_frame = cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY)
-    _, binary_frame = cv2.threshold(gray_frame, 85, 255, cv2.THRESH_BINARY)
-    blurred_frame = cv2.GaussianBlur(binary_frame, (75, 5), 0)
-
-    # Save the Gaussian blur image
-    blur_image_path = os.path.join(blur_dir, filename)
-    cv2.imwrite(blur_image_path, blurred_frame)
-
-    v = np.median(blurred_frame)
-    lower = int(max(0, 0.4 * v))
-    upper = int(min(255, 1.6 * v))
-    edges = cv2.Canny(blurred_frame, lower, upper)
-    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Save the processed image with edge detection lines
-    processed_image = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-    cv2.drawContours(processed_image, contours, -1, (0, 255, 0), 2)
-    processed_image_path = os.path.join(processed_dir, filename)
-    cv2.imwrite(processed_image_path, processed_image)
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if points is not None and ':' not in line:
+                points.append([float(v) for v in line.replace(',', ' ').split()])
+                continue
+            key, value = (part.strip() for part in line.split(':', 1))
+            if key == 'points':
+                points = []
+                calibration['points'] = points
+            elif key in ('shape', 'instructions'):
+                calibration[key] = value
+            else:
+                calibration[key] = float(value)
+    return calibration
+
+
+def read_calibration(file_path):
+    calibration = load_calibration(file_path)
+    return (calibration['shape'], calibration['min_volume'], calibration['max_volume'],
+            calibration.get('instructions', ''))
+
+
+def read_container_calibrations(calibration_files, n_containers):
+    """
+    One calibration dict (see load_calibration) per container. A single calibration file
+    is used for every container; otherwise there has to be one file per container.
+    """
+    if len(calibration_files) == 1:
+        calibration_files = list(calibration_files) * n_containers
+    if len(calibration_files) != n_containers:
+        raise ValueError(f"Got {len(calibration_files)} calibration files for {n_containers} containers")
+    return [load_calibration(calibration_file) for calibration_file in calibration_files]
+
+
+def measurement_settings(config):
+    """
+    Measurement settings from a config dict, as in edge_config_example.json: "rois" (x, y, width,
+    height per container, on the rotated frame for pi-camera.py), "calibration" (one file, or one
+    per ROI), and optionally "detector", "detection_params" and "audit_every". Returns the ROIs,
+    the compiled calibration tables, the detector, the detection parameters and audit_every.
+    """
+    rois = [tuple(roi) for roi in config['rois']]
+    calibration_files = config['calibration']
+    if isinstance(calibration_files, str):
+        calibration_files = [calibration_files]
+    calibrations = read_container_calibrations(calibration_files, len(rois))
+    return {'rois': rois,
+            'tables': calibration_tables(rois, calibrations),
+            'detector': config.get('detector', 'contour'),
+            'params': dict(DETECTION_PARAMS, **config.get('detection_params', {})),
+            'audit_every': config.get('audit_every', 60)}
+
+
+def read_measurement_config(config_path):
+    with open(config_path, 'r') as f:
+        return measurement_settings(json.load(f))
+
+
+def read_detection_params(config_path, defaults=DETECTION_PARAMS):
+    """
+    The "detection_params" of a measurement config (such as tune_detection.py writes) over defaults.
+    """
+    with open(config_path, 'r') as f:
+        params = dict(defaults, **json.load(f).get('detection_params', {}))
+    params['blur_kernel'] = tuple(params['blur_kernel'])
+    return params
 
+
+def cone_cylinder_volume(level, tip_height, radius, tip_radius=0.0):
+    """
+    Volume in mL of a tube with a conical tip below a cylinder, filled to level mm above the tip.
+    The tip widens from tip_radius at the bottom to radius at tip_height; all lengths in mm.
+    """
+    level = np.asarray(level, dtype=float)
+    cone_level = np.clip(level, 0, tip_height)
+    cone_radius = tip_radius + (radius - tip_radius) * cone_level / tip_height
+    cone = np.pi * cone_level / 3 * (tip_radius ** 2 + tip_radius * cone_radius + cone_radius ** 2)
+    cylinder = np.pi * radius ** 2 * np.clip(level - tip_height, 0, None)
+    return (cone + cylinder) / 1000
+
+
+def compile_calibration(calibration, container_height):
+    """
+    Volume for every integer height from 0 to container_height pixels in a ROI of that height.
+    The ROI bottom is at min_volume and its top at max_volume, for the shapes:
+    - cylindrical: volume linear in height
+    - conical: a conical tip below a cylinder, with tip_height, radius and optionally tip_radius in mm.
+      The levels of min_volume and max_volume are found on the tube, and the pixel heights in between
+      map linearly onto the liquid level.
+    - table: interpolated between measured points (fraction of the ROI height, volume)
+    """
+    shape = calibration['shape']
+    min_volume, max_volume = calibration.get('min_volume'), calibration.get('max_volume')
+    fractions = np.arange(int(container_height) + 1) / container_height
+
+    if shape == 'cylindrical':
+        return min_volume + fractions * (max_volume - min_volume)
+    if shape == 'conical':
+        geometry = (calibration['tip_height'], calibration['radius'], calibration.get('tip_radius', 0.0))
+        # Invert the volume on a fine grid of levels to find the ROI bottom and top on the tube
+        levels = np.linspace(0, geometry[0] + 1000 * max_volume / (np.pi * geometry[1] ** 2), 100001)
+        bottom, top = np.interp([min_volume, max_volume], cone_cylinder_volume(levels, *geometry), levels)
+        return cone_cylinder_volume(bottom + fractions * (top - bottom), *geometry)
+    if shape == 'table':
+        points = np.array(sorted(calibration['points']))
+        return np.interp(fractions, points[:, 0], points[:, 1])
+    raise ValueError(f"Unsupported shape {shape}")
+
+
+def calibration_tables(rois, calibrations):
+    # One lookup table per ROI, for container_volumes and heights_to_volumes
+    return [compile_calibration(calibration, roi[3]) for roi, calibration in zip(rois, calibrations)]
+
+
+def heights_to_volumes(heights, table):
+    """
+    Convert heights (a scalar or an array of any shape) to volumes with one interpolation
+    in a table from compile_calibration.
+    """
+    return np.interp(heights, np.arange(len(table)), table)
+
+class DebugImageWriter:
+    """
+    Decides which debug images (Gaussian blur and detected contours) are kept and writes them.
+
+    Policies: 'all' keeps every frame, 'every' keeps every Nth analysed frame, 'flagged' keeps
+    only frames where no meniscus was found (and outliers, see write_outlier_debug_images) and
+    'off' keeps nothing. Writes go through a background thread behind a bounded queue; when the
+    queue is full the image is dropped instead of blocking the measurement loop.
+    """
+    POLICIES = ('all', 'every', 'flagged', 'off')
+
+    def __init__(self, policy='all', every=10, queue_size=256, background=True):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown debug image policy: {policy}")
+        self.policy = policy
+        self.every = max(1, every)
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        if background and policy != 'off':
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def synchronous_copy(self):
+        # Worker processes cannot share the writer thread, so they write their own images
+        return DebugImageWriter(self.policy, self.every, background=False)
+
+    def wants_frame(self, frame_index):
+        if self.policy == 'off':
+            return False
+        if self.policy == 'every':
+            return frame_index % self.every == 0
+        return True
+
+    def keeps(self, height):
+        return self.policy != 'flagged' or height == 0
+
+    def write(self, path, image):
+        if self._queue is None:
+            with PROFILER.stage('debug_imwrite'):
+                cv2.imwrite(path, image)
+            return
+        try:
+            self._queue.put_nowait((path, image))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            with PROFILER.stage('debug_imwrite'):
+                cv2.imwrite(*item)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.dropped:
+            print(f"Dropped {self.dropped} debug images because the disk could not keep up")
+
+
+def find_meniscus_height(roi, contours, params=DETECTION_PARAMS):
     if not contours:
         return 0
 
@@ -55,7 +271,7 @@ def calculate_height(roi, frame, processed_dir, blur_dir, filename):
         aspect_ratio = w / float(h)
 
         # Check if the contour is horizontal
-        if aspect_ratio > 2.0:
+        if aspect_ratio > params['min_aspect_ratio']:
             length = cv2.arcLength(contour, True)
             if length > max_length:
                 max_length = length
@@ -69,16 +285,87 @@ def calculate_height(roi, frame, processed_dir, blur_dir, filename):
     return height
 
 
-def remove_outliers_and_interpolate(volumes, threshold=2):
+def calculate_height(roi, frame, processed_dir, blur_dir, filename, params=DETECTION_PARAMS, debug_writer=None):
+    with PROFILER.stage('threshold_blur'):
+        roi_frame = frame[int(roi[1]):int(roi[1] + roi[3]), int(roi[0]):int(roi[0] + roi[2])]
+        # Frames decoded in one of the grayscale modes need no conversion
+        gray_frame = roi_frame if roi_frame.ndim == 2 else cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY)
+        _, binary_frame = cv2.threshold(gray_frame, params['threshold'], 255, cv2.THRESH_BINARY)
+        blurred_frame = cv2.GaussianBlur(binary_frame, tuple(params['blur_kernel']), 0)
+
+    with PROFILER.stage('canny'):
+        v = np.median(blurred_frame)
+        lower = int(max(0, 0.4 * v))
+        upper = int(min(255, 1.6 * v))
+        edges = cv2.Canny(blurred_frame, lower, upper)
+
+    with PROFILER.stage('contours'):
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        height = find_meniscus_height(roi, contours, params)
+
+    if debug_writer is not None and debug_writer.keeps(height):
+        with PROFILER.stage('debug_images'):
+            # Save the Gaussian blur image
+            debug_writer.write(os.path.join(blur_dir, filename), blurred_frame)
+
+            # Save the processed image with edge detection lines
+            processed_image = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
+            cv2.drawContours(processed_image, contours, -1, (0, 255, 0), 2)
+            debug_writer.write(os.path.join(processed_dir, filename), processed_image)
+
+    return height
+
+
+def pyramid_factor(roi_height):
+    factor = 1
+    while roi_height // (2 * factor) >= PYRAMID_COARSE_ROWS:
+        factor *= 2
+    return factor
+
+
+def pyramid_height(roi, frame, processed_dir, blur_dir, filename, params=DETECTION_PARAMS, debug_writer=None):
+    """
+    calculate_height in two steps, so the cost hardly grows with the camera resolution. The meniscus
+    is first located on the ROI downscaled by pyramid_factor, with the blur kernel scaled to match
+    (the threshold is a grey level, which area averaging leaves unchanged). It is then found again at
+    full resolution in a strip of rows around that estimate. When either step finds nothing, or the
+    contour reaches the top of the strip, the whole ROI is searched at full resolution.
+    Only the full-resolution step saves debug images.
+    """
+    x, y, w, h = (int(v) for v in roi)
+    factor = pyramid_factor(h)
+    if factor == 1:
+        return calculate_height(roi, frame, processed_dir, blur_dir, filename, params, debug_writer)
+
+    with PROFILER.stage('pyramid_coarse'):
+        crop = gray_crop(frame, roi)
+        coarse = cv2.resize(crop, (max(1, w // factor), h // factor), interpolation=cv2.INTER_AREA)
+        coarse_height = calculate_height((0, 0, coarse.shape[1], coarse.shape[0]), coarse, None, None, filename,
+                                         scale_detection_params(params, factor))
+    if coarse_height:
+        # The strip covers the coarse rounding plus the vertical reach of the full-resolution blur
+        row = y + h - int(round(coarse_height * h / coarse.shape[0]))
+        margin = PYRAMID_REFINE_ROWS * factor + params['blur_kernel'][1]
+        top, bottom = max(y, row - margin), min(y + h, row + margin)
+        with PROFILER.stage('pyramid_refine'):
+            strip_height = calculate_height((x, top, w, bottom - top), frame, processed_dir, blur_dir, filename,
+                                            params, debug_writer)
+        if 0 < strip_height < bottom - top or (strip_height and top == y):
+            return y + h - bottom + strip_height
+    return calculate_height(roi, frame, processed_dir, blur_dir, filename, params, debug_writer)
+
+
+@PROFILER.timed()
+def remove_outliers_and_interpolate(volumes, threshold=2, max_volume=6):
     """
     Remove outliers based on the Z-score method and interpolate the missing values.
-    Also, remove all values above 5 ml.
+    Also, remove all values above max_volume.
     """
     # Convert volumes to numpy array for easier processing
     volumes = np.array(volumes)
 
     # Remove values above max
-    volumes[volumes > 6] = np.nan
+    volumes[volumes > max_volume] = np.nan
 
     # Calculate Z-scores to detect outliers
     mean_volume = np.nanmean(volumes)
@@ -98,134 +385,1173 @@ def remove_outliers_and_interpolate(volumes, threshold=2):
     return clean_volumes
 
 
-def process_images(directory, r1, r2, shape, min_volume, max_volume):
-    volumes = []
-    timestamps = []
-    raw_heights = []
-    frames = []
+class StreamingOutlierFilter:
+    """
+    Online alternative to remove_outliers_and_interpolate that cleans one sample at a time.
+
+    A Hampel filter over the last `window` accepted-or-rejected samples: a sample above max_volume,
+    or further than n_sigmas robust standard deviations (1.4826 * MAD) from the rolling median, is
+    an outlier and is replaced by that median. Time and memory per sample depend only on the window,
+    not on the length of the run. Genuine level changes are accepted once they fill half the window.
+    """
+
+    def __init__(self, window=7, n_sigmas=3.0, max_volume=6, min_deviation=0.05):
+        self.history = deque(maxlen=window)
+        self.n_sigmas = n_sigmas
+        self.max_volume = max_volume
+        # Floor for the robust standard deviation, so a perfectly flat stretch does not flag every change
+        self.min_deviation = min_deviation
+
+    def update(self, volume):
+        """
+        Returns the cleaned volume and whether the sample was treated as an outlier.
+        Before any valid sample has been seen, outliers come back as NaN.
+        """
+        if np.isnan(volume) or volume > self.max_volume:
+            return (float(np.median(self.history)) if self.history else np.nan), True
+
+        self.history.append(volume)
+        if len(self.history) < 3:
+            return volume, False
+
+        median = float(np.median(self.history))
+        deviation = max(1.4826 * float(np.median(np.abs(np.array(self.history) - median))), self.min_deviation)
+        if abs(volume - median) > self.n_sigmas * deviation:
+            return median, True
+        return volume, False
+
+
+class RoiChangeDetector:
+    """
+    Skips the meniscus detection for ROIs that have not changed since they were last measured.
+
+    Each ROI crop is reduced to a thumbnail of cell x cell pixel averages and compared with the
+    thumbnail of the last crop that went through calculate_height. If no cell differs by more than
+    tolerance grey levels, the height measured then is reused. The comparison is always against
+    the last fully measured crop, not the previous frame, so slow drifts add up until they count as
+    a change. Every ROI is measured again after force_every reuses in a row regardless, and
+    measure_images clears the references (reset) every restart_every frames, which is when an
+    unchanged ROI is measured again without a reset too.
+    """
+
+    def __init__(self, tolerance=8, force_every=30, cell=4):
+        self.tolerance = tolerance
+        self.force_every = force_every
+        self.cell = cell
+        # A measurement and force_every reuses
+        self.restart_every = force_every + 1
+        self.references = {}    # ROI index -> (thumbnail, height, reuses since it was measured)
+        self.reused = 0
+        self.measured = 0
+
+    def settings(self):
+        # Part of the height cache key, since reused heights can differ from measured ones
+        return {'tolerance': self.tolerance, 'force_every': self.force_every, 'cell': self.cell}
+
+    def reset(self):
+        # Measure every ROI again; the counts are kept
+        self.references = {}
+
+    def thumbnail(self, crop):
+        size = (max(1, crop.shape[1] // self.cell), max(1, crop.shape[0] // self.cell))
+        return cv2.resize(crop, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def height(self, roi_index, crop, measure):
+        """
+        The height of the ROI from the crop: the previous height if the crop is unchanged,
+        otherwise measure() is called and its height becomes the new reference.
+        """
+        thumbnail = self.thumbnail(crop)
+        reference = self.references.get(roi_index)
+        if (reference is not None and reference[2] < self.force_every and reference[0].shape == thumbnail.shape
+                and np.abs(thumbnail - reference[0]).max() <= self.tolerance):
+            self.references[roi_index] = (reference[0], reference[1], reference[2] + 1)
+            self.reused += 1
+            return reference[1]
+
+        height = measure()
+        self.references[roi_index] = (thumbnail, height, 0)
+        self.measured += 1
+        return height
+
+    def add_counts(self, other):
+        # Counts from a copy that ran in a worker process
+        self.reused += other.reused
+        self.measured += other.measured
+
+    def summary(self):
+        total = self.reused + self.measured
+        rate = self.reused / total if total else 0.0
+        return (f"Unchanged ROIs: reused the previous height for {self.reused} of {total} ROI crops "
+                f"({100 * rate:.1f}% hit rate)")
+
+
+class MeniscusTracker:
+    """
+    Looks for the meniscus in a band of rows around where it was found in the previous frame,
+    instead of in the whole ROI. The band reaches band pixels above and below the previous
+    meniscus row. When nothing is found in the band, or the contour runs into the top of the band
+    (so the meniscus may lie just outside it), the band is doubled until it covers the ROI and
+    the whole ROI is searched. The first frame, any frame after one without a meniscus and every
+    rescan_every-th frame of a ROI are full-ROI searches, so the tracker cannot stay locked onto
+    a wrong contour that the first search happened to pick. measure_images restarts the tracker
+    (reset) every restart_every frames, which is when the rescan falls due without a restart too.
+    """
+
+    def __init__(self, band=20, rescan_every=50):
+        self.band = band
+        self.rescan_every = rescan_every
+        # A full-ROI search and rescan_every band searches
+        self.restart_every = rescan_every + 1
+        self.previous = {}      # ROI index -> height in the previous frame
+        self.since_scan = {}    # ROI index -> band searches since the last full-ROI search
+        self.in_band = 0
+        self.widened = 0
+        self.full_scans = 0
+
+    def settings(self):
+        # Part of the height cache key, since a band can miss a contour that a full search finds
+        return {'band': self.band, 'rescan_every': self.rescan_every}
+
+    def reset(self):
+        # Start over with full-ROI searches; the counts are kept
+        self.previous = {}
+        self.since_scan = {}
+
+    def height(self, roi_index, roi, measure):
+        """
+        The height in roi, from measure(search_roi) with search_roi a band of rows of the ROI
+        (measure returns the height within search_roi, 0 for no meniscus).
+        """
+        x, y, w, h = (int(v) for v in roi)
+        previous = self.previous.get(roi_index, 0)
+        if self.since_scan.get(roi_index, 0) >= self.rescan_every:
+            previous = 0
+        band = self.band
+        while previous and 2 * band < h:
+            row = y + h - previous
+            top, bottom = max(y, row - band), min(y + h, row + band)
+            band_height = measure((x, top, w, bottom - top))
+            if 0 < band_height < bottom - top or (band_height and top == y):
+                if band == self.band:
+                    self.in_band += 1
+                else:
+                    self.widened += 1
+                height = y + h - bottom + band_height
+                self.previous[roi_index] = height
+                self.since_scan[roi_index] = self.since_scan.get(roi_index, 0) + 1
+                return height
+            band *= 2
+
+        self.full_scans += 1
+        height = measure(roi)
+        self.previous[roi_index] = height
+        self.since_scan[roi_index] = 0
+        return height
+
+    def add_counts(self, other):
+        # Counts from a copy that ran in a worker process
+        self.in_band += other.in_band
+        self.widened += other.widened
+        self.full_scans += other.full_scans
+
+    def summary(self):
+        total = self.in_band + self.widened + self.full_scans
+        return (f"Meniscus tracking: {self.in_band} of {total} ROI searches found the meniscus in the "
+                f"{2 * self.band} px band, {self.widened} in a wider band, {self.full_scans} searched the whole ROI")
+
+
+def profile_heights(crops, params=DETECTION_PARAMS):
+    """
+    Vectorised meniscus detection for a stack of grayscale ROI crops of shape (frames, rows, columns).
+    Each crop is reduced to the fraction of bright pixels per row, smoothed over the height of the
+    blur kernel, and the meniscus is taken at the steepest bright-to-dark step going down the ROI.
+    Frames without a clear step get a height of 0, like calculate_height.
+    """
+    n_frames, roi_height, _ = crops.shape
+    k = params['blur_kernel'][1]
+    if roi_height <= k:
+        return np.zeros(n_frames, dtype=int)
+
+    profiles = (crops > params['threshold']).mean(axis=2)
+
+    # Moving average over k rows via a cumulative sum, for all frames at once
+    cumulative = np.cumsum(np.pad(profiles, ((0, 0), (1, 0))), axis=1)
+    smoothed = (cumulative[:, k:] - cumulative[:, :-k]) / k
+    steps = np.diff(smoothed, axis=1)
+
+    step_index = np.argmin(steps, axis=1)
+    step_size = -steps[np.arange(n_frames), step_index]
+    meniscus_rows = step_index + k // 2
+    return np.where(step_size * k >= PROFILE_MIN_STEP, roi_height - meniscus_rows, 0)
+
+
+def scale_roi(roi, factor):
+    """
+    The ROI in the coordinates of an image decoded at 1/factor scale, grown outwards
+    so that it still covers the full-resolution ROI.
+    """
+    x0, y0 = int(roi[0]) // factor, int(roi[1]) // factor
+    x1 = -(-(int(roi[0]) + int(roi[2])) // factor)
+    y1 = -(-(int(roi[1]) + int(roi[3])) // factor)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def scale_detection_params(params, factor):
+    # Gaussian kernel sizes have to stay odd
+    blur_kernel = tuple(max(1, int(round(k / factor)) | 1) for k in params['blur_kernel'])
+    return dict(params, blur_kernel=blur_kernel)
+
+
+def resolve_decode_mode(decode, rois):
+    """
+    Fall back to a smaller reduction (down to a full-resolution grayscale decode)
+    when the ROIs would become too narrow at the requested scale.
+    """
+    _, factor = DECODE_MODES[decode]
+    while factor > 1 and min(int(roi[2]) for roi in rois) // factor < MIN_REDUCED_ROI_WIDTH:
+        factor //= 2
+        fallback = 'gray' if factor == 1 else f'reduced{factor}'
+        print(f"ROIs too narrow for '{decode}' decoding, using '{fallback}' instead")
+        decode = fallback
+    return decode
+
+
+def full_resolution_height(roi, scaled_roi, height, factor):
+    """
+    Map a height measured in a ROI of a reduced decode back onto the full-resolution ROI.
+    Works on scalars and arrays; a height of 0 (no meniscus) stays 0.
+    """
+    if factor == 1:
+        return height
+    meniscus_row = (scaled_roi[1] + scaled_roi[3] - height) * factor
+    return np.where(height > 0, int(roi[1]) + int(roi[3]) - meniscus_row, 0)
+
 
-    # Create subdirectories for processed and blur images
+@PROFILER.timed('frame')
+def measure_image(directory, filename, rois, container_dirs, decode='full', params=DETECTION_PARAMS,
+                  debug_writer=None, frame_index=0, change_detector=None, tracker=None, detector='contour'):
+    """
+    Read one image and calculate the liquid height for every ROI.
+    Kept at module level so it can be shipped to worker processes.
+    Only the heights are returned; the decoded frame is dropped straight away.
+    Heights are always in full-resolution pixels, whatever the decode mode.
+    With a change_detector (RoiChangeDetector), ROIs that have not changed keep their previous height.
+    With a tracker (MeniscusTracker), the meniscus is searched for around its previous position first.
+    detector is 'contour' (calculate_height) or 'pyramid' (pyramid_height).
+    """
+    filepath = os.path.join(directory, filename)
+    flags, factor = DECODE_MODES[decode]
+    with PROFILER.stage('imread'):
+        frame = cv2.imread(filepath, flags)
+    if frame is None:
+        raise ValueError(f"could not decode {filepath}")
+
+    # Rotate the image 180 degrees
+    #frame = cv2.rotate(frame, cv2.ROTATE_180)
+
+    if debug_writer is not None and not debug_writer.wants_frame(frame_index):
+        debug_writer = None
+
+    if factor == 1:
+        return tuple(roi_heights([frame] * len(rois), rois, container_dirs, filename, params, debug_writer,
+                                 change_detector, tracker, detector))
+
+    scaled_rois = [scale_roi(roi, factor) for roi in rois]
+    heights = roi_heights([frame] * len(rois), scaled_rois, container_dirs, filename,
+                          scale_detection_params(params, factor), debug_writer, change_detector, tracker, detector)
+    return tuple(int(full_resolution_height(roi, scaled_roi, height, factor))
+                 for roi, scaled_roi, height in zip(rois, scaled_rois, heights))
+
+
+def roi_heights(frames, rois, container_dirs, filename, params=DETECTION_PARAMS, debug_writer=None,
+                change_detector=None, tracker=None, detector='contour'):
+    """
+    The height in every ROI, each measured in its own frame: the same decoded image for every ROI
+    (measure_image), or the ROI's crop from the crop cache (measure_cached_image).
+    """
+    find_height = pyramid_height if detector == 'pyramid' else calculate_height
+    heights = []
+    for i, (frame, roi, (processed_dir, blur_dir)) in enumerate(zip(frames, rois, container_dirs)):
+        def measure(search_roi):
+            return find_height(search_roi, frame, processed_dir, blur_dir, filename, params, debug_writer)
+
+        detect = partial(tracker.height, i, roi, measure) if tracker is not None else partial(measure, roi)
+        if change_detector is None:
+            heights.append(detect())
+        else:
+            heights.append(change_detector.height(i, gray_crop(frame, roi), detect))
+    return heights
+
+
+@PROFILER.timed('batch')
+def measure_image_batch(filenames, directory, rois, decode='full', params=DETECTION_PARAMS):
+    """
+    Measure a batch of images with the profile detector. Each image is decoded once and cut
+    into its ROI crops straight away; the crops of each ROI are then stacked and evaluated
+    in a single vectorised pass.
+    """
+    flags, factor = DECODE_MODES[decode]
+    scaled_rois = [scale_roi(roi, factor) for roi in rois]
+    scaled_params = scale_detection_params(params, factor) if factor > 1 else params
+
+    crops = [[] for _ in rois]
+    for filename in filenames:
+        with PROFILER.stage('imread'):
+            frame = cv2.imread(os.path.join(directory, filename), flags)
+        if frame is None:
+            raise ValueError(f"could not decode {os.path.join(directory, filename)}")
+        for roi_crops, scaled_roi in zip(crops, scaled_rois):
+            roi_crops.append(gray_crop(frame, scaled_roi))
+
+    with PROFILER.stage('profile_heights'):
+        heights = [full_resolution_height(roi, scaled_roi, profile_heights(np.stack(roi_crops), scaled_params),
+                                          factor)
+                   for roi, scaled_roi, roi_crops in zip(rois, scaled_rois, crops)]
+    return [tuple(int(h) for h in frame_heights) for frame_heights in zip(*heights)]
+
+
+def gray_crop(frame, roi):
+    x, y, w, h = (int(v) for v in roi)
+    crop = frame[y:y + h, x:x + w]
+    return crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+
+
+def measure_frame(frame, rois, params=DETECTION_PARAMS, detector='contour'):
+    """
+    Heights for every ROI of a frame that is already in memory, such as the array from a camera
+    capture, so nothing has to be JPEG-encoded and decoded again. Frames straight from the camera
+    may have a fourth (padding) channel; the BGR to gray conversion accepts those too.
+    """
+    if detector == 'profile':
+        return tuple(int(profile_heights(gray_crop(frame, roi)[np.newaxis], params)[0]) for roi in rois)
+    find_height = pyramid_height if detector == 'pyramid' else calculate_height
+    return tuple(find_height(roi, frame, None, None, None, params) for roi in rois)
+
+
+class CropCache:
+    """
+    The grayscale ROI crops of every image of an experiment, decoded once by extract_crops. The crops
+    of each ROI are one contiguous memory-mapped array (roi1.npy, roi2.npy, ...: frames x rows x columns),
+    indexed by index.json (ROIs, decode mode, file names and identities) and timestamps.npy (datetime64,
+    sorted). Reading a frame is a slice of the maps, so a rerun with other detection parameters decodes
+    no JPEGs at all. With a reduced decode mode the crops are stored at the reduced scale.
+    Only the paths are pickled; worker processes map the arrays themselves.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, CROP_CACHE_DIR)
+        with open(os.path.join(self.path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.rois = [tuple(roi) for roi in index['rois']]
+        self.decode = index['decode']
+        self.filenames = index['filenames']
+        self.identities = index['identities']
+        self.positions = {filename: i for i, filename in enumerate(self.filenames)}
+        self._crops = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _crops=None)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @property
+    def crops(self):
+        if self._crops is None:
+            self._crops = [np.load(os.path.join(self.path, f"roi{i + 1}.npy"), mmap_mode='r')
+                           for i in range(len(self.rois))]
+        return self._crops
+
+    @property
+    def timestamps(self):
+        return np.load(os.path.join(self.path, 'timestamps.npy'))
+
+    def frame(self, filename):
+        # One crop per ROI, as views into the maps; None for an image that is not in the cache
+        position = self.positions.get(filename)
+        if position is None:
+            return None
+        return [crops[position] for crops in self.crops]
+
+    def between(self, start, end):
+        """
+        The positions of the frames taken from start up to (not including) end, as a slice that
+        selects them from the maps without a copy. start and end are datetime64 or ISO strings.
+        """
+        first, last = np.searchsorted(self.timestamps, [np.datetime64(start), np.datetime64(end)])
+        return slice(int(first), int(last))
+
+
+def open_crop_cache(directory, rois, decode='full'):
+    """
+    The crop cache of directory if it was extracted with these ROIs and decode mode, otherwise None.
+    """
+    try:
+        cache = CropCache(directory)
+        complete = all(len(crops) == len(cache) for crops in cache.crops)
+    except (OSError, ValueError, KeyError):
+        return None
+    if not complete or cache.decode != decode or cache.rois != [tuple(int(v) for v in roi) for roi in rois]:
+        return None
+    return cache
+
+
+def read_roi_crops(filename, directory, rois, decode='full'):
+    # Module level, so extract_crops can hand it to worker processes
+    flags, factor = DECODE_MODES[decode]
+    frame = cv2.imread(os.path.join(directory, filename), flags)
+    return [gray_crop(frame, scale_roi(roi, factor)) for roi in rois]
+
+
+@PROFILER.timed()
+def extract_crops(directory, rois, decode='full', filenames=None, workers=1):
+    """
+    Decode every image once and write its ROI crops to the crop cache (see CropCache). An existing
+    cache made with the same ROIs and decode mode is extended: the crops of unchanged images are
+    copied over from the old maps and only new or changed images are decoded. Returns the CropCache.
+    """
+    filenames = list_images(directory) if filenames is None else list(filenames)
+    if not filenames:
+        raise FileNotFoundError(f"No images in {directory}")
+    decode = resolve_decode_mode(decode, rois)
+    identities = [file_identity(os.path.join(directory, filename)) for filename in filenames]
+    old = open_crop_cache(directory, rois, decode)
+    if old is not None and old.filenames == filenames and old.identities == identities:
+        return old
+
+    reused = {}
+    if old is not None:
+        for i, (filename, identity) in enumerate(zip(filenames, identities)):
+            position = old.positions.get(filename)
+            if position is not None and old.identities[position] == identity:
+                reused[i] = position
+    todo = [i for i in range(len(filenames)) if i not in reused]
+    print(f"Extracting the ROI crops of {len(todo)} images ({len(reused)} already extracted)")
+
+    # The new maps are written under temporary names and only replace the old cache once complete
+    path = os.path.join(directory, CROP_CACHE_DIR)
+    os.makedirs(path, exist_ok=True)
+    _, factor = DECODE_MODES[decode]
+    scaled_rois = [scale_roi(roi, factor) for roi in rois]
+    maps = [np.lib.format.open_memmap(os.path.join(path, f"roi{k + 1}.npy.tmp"), mode='w+', dtype=np.uint8,
+                                      shape=(len(filenames), h, w))
+            for k, (_, _, w, h) in enumerate(scaled_rois)]
+    for i, position in reused.items():
+        for crops, old_crops in zip(maps, old.crops):
+            crops[i] = old_crops[position]
+
+    read = partial(read_roi_crops, directory=directory, rois=rois, decode=decode)
+    todo_filenames = [filenames[i] for i in todo]
+    if workers <= 1:
+        frames = map(read, todo_filenames)
+    else:
+        pool = Pool(workers)
+        frames = pool.imap(read, todo_filenames, chunksize=max(1, len(todo) // (workers * 4)))
+    try:
+        for i, frame_crops in zip(todo, frames):
+            for crops, crop in zip(maps, frame_crops):
+                crops[i] = crop
+    finally:
+        if workers > 1:
+            pool.close()
+            pool.join()
+    for crops in maps:
+        crops.flush()
+    del maps, crops
+    if old is not None:
+        old._crops = None
+
+    timestamps = as_datetime64([time.strptime(f.split('.')[0], "%Y%m%d-%H%M%S") for f in filenames])
+    np.save(os.path.join(path, 'timestamps.npy'), timestamps)
+    for k in range(len(rois)):
+        os.replace(os.path.join(path, f"roi{k + 1}.npy.tmp"), os.path.join(path, f"roi{k + 1}.npy"))
+    tmp_file = os.path.join(path, 'index.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump({'rois': [[int(v) for v in roi] for roi in rois], 'decode': decode,
+                   'filenames': filenames, 'identities': identities}, f)
+    os.replace(tmp_file, os.path.join(path, 'index.json'))
+    return CropCache(directory)
+
+
+@PROFILER.timed('frame')
+def measure_cached_image(directory, filename, crops, rois, container_dirs, decode='full', params=DETECTION_PARAMS,
+                         debug_writer=None, frame_index=0, change_detector=None, tracker=None, detector='contour'):
+    """
+    measure_image for an image in the crop cache (crops, a CropCache): every ROI is measured in its own
+    crop, sliced from the maps, so nothing is decoded. The heights are the same as from measure_image.
+    Images that are not in the cache are read and measured as usual.
+    """
+    roi_frames = crops.frame(filename)
+    if roi_frames is None:
+        return measure_image(directory, filename, rois, container_dirs, decode, params, debug_writer, frame_index,
+                             change_detector, tracker, detector)
+    if debug_writer is not None and not debug_writer.wants_frame(frame_index):
+        debug_writer = None
+
+    # In its crop, a ROI starts at the origin
+    _, factor = DECODE_MODES[crops.decode]
+    crop_rois = [(0, 0, crop.shape[1], crop.shape[0]) for crop in roi_frames]
+    crop_params = scale_detection_params(params, factor) if factor > 1 else params
+    heights = roi_heights(roi_frames, crop_rois, container_dirs, filename, crop_params, debug_writer,
+                          change_detector, tracker, detector)
+    if factor == 1:
+        return tuple(heights)
+    return tuple(int(full_resolution_height(roi, scale_roi(roi, factor), height, factor))
+                 for roi, height in zip(rois, heights))
+
+
+@PROFILER.timed('batch')
+def measure_cached_batch(filenames, directory, crops, rois, decode='full', params=DETECTION_PARAMS):
+    """
+    measure_image_batch from the crop cache. A batch of consecutive cached images is a slice of the
+    maps, so the profile detector runs on the mapped crops without copying them first.
+    """
+    positions = [crops.positions.get(filename) for filename in filenames]
+    if None in positions:
+        return measure_image_batch(filenames, directory, rois, decode, params)
+    if positions == list(range(positions[0], positions[0] + len(positions))):
+        positions = slice(positions[0], positions[0] + len(positions))
+
+    _, factor = DECODE_MODES[crops.decode]
+    scaled_params = scale_detection_params(params, factor) if factor > 1 else params
+    with PROFILER.stage('profile_heights'):
+        heights = [full_resolution_height(roi, scale_roi(roi, factor), profile_heights(roi_crops[positions],
+                                                                                       scaled_params), factor)
+                   for roi, roi_crops in zip(rois, crops.crops)]
+    return [tuple(int(h) for h in frame_heights) for frame_heights in zip(*heights)]
+
+
+def measure_numbered_image(numbered_filename, directory, crops=None, **kwargs):
+    frame_index, filename = numbered_filename
+    if crops is not None:
+        return measure_cached_image(directory, filename, crops, frame_index=frame_index, **kwargs)
+    return measure_image(directory, filename, frame_index=frame_index, **kwargs)
+
+
+def search_restart_every(change_detector=None, tracker=None):
+    """
+    The change detector and tracker restart together, every this many frames, so the worker processes
+    can take runs of images that start there and still measure what a single process would. The
+    period is the longest of their own, so --rescan-every and --force-every keep their meaning.
+    None without either.
+    """
+    periods = [state.restart_every for state in (change_detector, tracker) if state is not None]
+    return max(periods) if periods else None
+
+
+def measure_numbered_images(numbered_filenames, measure, change_detector=None, tracker=None):
+    # Both restart at every multiple of search_restart_every, and wherever a run begins or skips past one
+    restart_every = search_restart_every(change_detector, tracker)
+    block = None
+    for numbered_filename in numbered_filenames:
+        if restart_every and numbered_filename[0] // restart_every != block:
+            block = numbered_filename[0] // restart_every
+            for state in (change_detector, tracker):
+                if state is not None:
+                    state.reset()
+        yield measure(numbered_filename, change_detector=change_detector, tracker=tracker)
+
+
+def measure_image_run(numbered_filenames, measure, change_detector=None, tracker=None):
+    """
+    Measure an ordered run of images in a worker process. A change detector or tracker arrives as
+    the worker's own copy, so it only follows the images within the run; both are returned for their counts.
+    """
+    heights = list(measure_numbered_images(numbered_filenames, measure, change_detector, tracker))
+    return heights, change_detector, tracker
+
+
+def measure_images(directory, filenames, rois, container_dirs, workers=1, decode='full', params=DETECTION_PARAMS,
+                   debug_writer=None, detector='contour', change_detector=None, tracker=None, crops=None,
+                   frame_indices=None):
+    """
+    Yield the heights for each filename, in the order given. frame_indices are the positions of the
+    filenames in the whole series (default 0, 1, 2, ...), which the restarts below are counted from.
+    With workers > 1 the images are spread over a process pool in ordered chunks.
+    change_detector (a RoiChangeDetector) skips ROIs that have not changed and tracker (a MeniscusTracker)
+    searches around the previous meniscus first. Neither is used by the profile detector, which scans whole
+    ROIs in one vectorised pass for less than the change check or band search would cost. Both
+    restart every search_restart_every frames and the chunks start at those frames, so the heights
+    are the same with any number of workers.
+    With crops (a CropCache), the images are measured from their cached ROI crops instead of being decoded.
+    """
+    if detector == 'profile':
+        yield from measure_image_batches(directory, filenames, rois, workers, decode, params, crops)
+        return
+
+    if workers > 1 and debug_writer is not None:
+        debug_writer = debug_writer.synchronous_copy()
+    measure = partial(measure_numbered_image, directory=directory, crops=crops, rois=rois,
+                      container_dirs=container_dirs, decode=decode, params=params, debug_writer=debug_writer,
+                      detector=detector)
+    numbered_filenames = list(enumerate(filenames) if frame_indices is None else zip(frame_indices, filenames))
+    if workers <= 1:
+        yield from measure_numbered_images(numbered_filenames, measure, change_detector, tracker)
+        return
+
+    chunksize = max(1, len(filenames) // (workers * 4))
+    if change_detector is None and tracker is None:
+        runs = [numbered_filenames[i:i + chunksize] for i in range(0, len(numbered_filenames), chunksize)]
+    else:
+        # Runs start where both restart anyway, so the heights do not depend on the number of workers
+        restart_every = search_restart_every(change_detector, tracker)
+        runs = []
+        for _, block in itertools.groupby(numbered_filenames, key=lambda item: item[0] // restart_every):
+            if runs and len(runs[-1]) < chunksize:
+                runs[-1].extend(block)
+            else:
+                runs.append(list(block))
+    measure_run = partial(measure_image_run, measure=measure, change_detector=change_detector, tracker=tracker)
+    if PROFILER.enabled:
+        # The workers send their stage timings back with every run
+        measure_run = partial(profiled, measure_run)
+    with Pool(workers) as pool:
+        for result in pool.imap(measure_run, runs):
+            if PROFILER.enabled:
+                result, samples = result
+                PROFILER.merge(samples)
+            run_heights, run_change_detector, run_tracker = result
+            if change_detector is not None:
+                change_detector.add_counts(run_change_detector)
+            if tracker is not None:
+                tracker.add_counts(run_tracker)
+            yield from run_heights
+
+
+def measure_image_batches(directory, filenames, rois, workers=1, decode='full', params=DETECTION_PARAMS, crops=None):
+    # The profile detector works on batches of frames, so batches are what is handed to the workers
+    batches = [filenames[i:i + PROFILE_BATCH_SIZE] for i in range(0, len(filenames), PROFILE_BATCH_SIZE)]
+    if crops is not None:
+        measure = partial(measure_cached_batch, directory=directory, crops=crops, rois=rois, decode=decode,
+                          params=params)
+    else:
+        measure = partial(measure_image_batch, directory=directory, rois=rois, decode=decode, params=params)
+    if workers <= 1:
+        for batch in batches:
+            yield from measure(batch)
+        return
+
+    with Pool(workers) as pool:
+        if not PROFILER.enabled:
+            for batch_heights in pool.imap(measure, batches):
+                yield from batch_heights
+            return
+        for batch_heights, samples in pool.imap(partial(profiled, measure), batches):
+            PROFILER.merge(samples)
+            yield from batch_heights
+
+
+@PROFILER.timed()
+def write_outlier_debug_images(directory, filenames, raw_volumes, clean_volumes, rois, decode='full',
+                               params=DETECTION_PARAMS, debug_writer=None, detector='contour', crops=None):
+    """
+    With the 'flagged' policy, outliers are only known once the whole series has been cleaned,
+    so the debug images of those frames are made afterwards by measuring them again, with the same
+    detector and, with crops (a CropCache), from the same crops as the run. The debug directories
+    are only created here, for that policy.
+    """
+    if debug_writer is None or debug_writer.policy != 'flagged':
+        return
+    container_dirs = prepare_output_dirs(directory, len(rois))
+    raw_volumes = np.array(raw_volumes, dtype=float)
+    clean_volumes = np.array(clean_volumes, dtype=float)
+    replaced = ~np.isclose(raw_volumes, clean_volumes, equal_nan=True).all(axis=1)
+
+    flagged_writer = DebugImageWriter('all', background=False)
+    for filename in np.array(filenames)[replaced]:
+        if crops is not None:
+            measure_cached_image(directory, filename, crops, rois, container_dirs, decode, params, flagged_writer,
+                                 detector=detector)
+        else:
+            measure_image(directory, filename, rois, container_dirs, decode, params, flagged_writer,
+                          detector=detector)
+
+
+def list_images(directory):
+    return [f for f in sorted(os.listdir(directory)) if f.endswith(".jpg")]
+
+
+def prepare_output_dirs(directory, n_containers=2):
+    """
+    Create the processed and blur image subdirectories and return a
+    (processed_dir, blur_dir) pair for each container.
+    """
     processed_dir = os.path.join(directory, "processed_images")
     blur_dir = os.path.join(directory, "blur_images")
-    container1_processed_dir = os.path.join(processed_dir, "container1")
-    container2_processed_dir = os.path.join(processed_dir, "container2")
-    container1_blur_dir = os.path.join(blur_dir, "container1")
-    container2_blur_dir = os.path.join(blur_dir, "container2")
+    container_dirs = [(os.path.join(processed_dir, f"container{i + 1}"), os.path.join(blur_dir, f"container{i + 1}"))
+                      for i in range(n_containers)]
 
-    for dir_path in [processed_dir, blur_dir, container1_processed_dir, container2_processed_dir, container1_blur_dir,
-                     container2_blur_dir]:
+    for dir_path in [processed_dir, blur_dir] + [d for pair in container_dirs for d in pair]:
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
+    return container_dirs
 
-    for filename in sorted(os.listdir(directory)):
-        if filename.endswith(".jpg"):
-            filepath = os.path.join(directory, filename)
-            frame = cv2.imread(filepath)
 
-            # Rotate the image 180 degrees
-            #frame = cv2.rotate(frame, cv2.ROTATE_180)
+def file_identity(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
 
-            frames.append(frame)
-            timestamp = time.strptime(filename.split('.')[0], "%Y%m%d-%H%M%S")
-            timestamps.append(timestamp)
 
-            # Calculate heights from the images
-            height1 = calculate_height(r1, frame, container1_processed_dir, container1_blur_dir, filename)
-            height2 = calculate_height(r2, frame, container2_processed_dir, container2_blur_dir, filename)
+def height_cache_key(rois, params):
+    """
+    Everything besides the image itself that changes the measured heights.
+    Round-tripped through JSON so it compares equal to a key loaded from disk.
+    """
+    return json.loads(json.dumps({'rois': [[int(v) for v in roi] for roi in rois], 'params': params}))
+
+
+def load_height_cache(cache_file, cache_key):
+    """
+    Returns {filename: (identity, heights)} from the cache file.
+    The cache is ignored as a whole if it was made with other ROIs or detection parameters.
+    """
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        print(f"Ignoring unreadable height cache {cache_file}")
+        return {}
+
+    if data.get('key') != cache_key:
+        return {}
+    return {filename: (entry['identity'], tuple(entry['heights'])) for filename, entry in data['entries'].items()}
+
+
+@PROFILER.timed()
+def save_height_cache(cache_file, cache_key, entries):
+    # Write to a temporary file first so an interrupted run never leaves a truncated cache
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'key': cache_key,
+                   'entries': {filename: {'identity': identity, 'heights': list(heights)}
+                               for filename, (identity, heights) in entries.items()}}, f)
+    os.replace(tmp_file, cache_file)
+
+
+def cached_measurements(directory, filenames, cache_key, measure, use_cache=True, save_every=200, cache_file=None,
+                        restart_every=None):
+    """
+    Yield the heights for each filename, taking them from the height cache where the
+    file (name, size and mtime) is unchanged and calling measure(filenames, frame_indices=positions)
+    for the rest, with their positions in filenames.
+    With restart_every (for a tracker or change detector, which restart every restart_every frames),
+    the images from the last restart before each new image are measured again as well, so the new
+    heights are the same as in a run without the cache.
+    The cache is saved periodically and when the run ends, so an interrupted run resumes
+    where it stopped. cache_file defaults to height_cache.json in the image directory.
+    """
+    if not use_cache:
+        yield from measure(filenames)
+        return
+
+    cache_file = cache_file or os.path.join(directory, HEIGHT_CACHE_FILE)
+    entries = load_height_cache(cache_file, cache_key)
+    identities = {filename: file_identity(os.path.join(directory, filename)) for filename in filenames}
+    todo = [filename for filename in filenames
+            if filename not in entries or entries[filename][0] != identities[filename]]
+    if todo:
+        print(f"Analysing {len(todo)} new or changed images ({len(filenames) - len(todo)} cached)")
+    positions = {filename: i for i, filename in enumerate(filenames)}
+    if restart_every and todo:
+        # The last new image of every restart block, and everything before it in that block
+        last_todo = {}
+        for filename in todo:
+            last_todo[positions[filename] // restart_every] = positions[filename]
+        new_count = len(todo)
+        todo = [filename for i, filename in enumerate(filenames)
+                if i <= last_todo.get(i // restart_every, -1)]
+        if len(todo) > new_count:
+            print(f"Measuring {len(todo) - new_count} cached images again from the last restart of the search")
+
+    fresh = measure(todo, frame_indices=[positions[filename] for filename in todo])
+    todo = set(todo)
+    measured = 0
+    try:
+        for filename in filenames:
+            if filename in todo:
+                heights = tuple(next(fresh))
+                entries[filename] = (identities[filename], heights)
+                measured += 1
+                if measured % save_every == 0:
+                    save_height_cache(cache_file, cache_key, entries)
+            yield entries[filename][1]
+    finally:
+        if measured:
+            save_height_cache(cache_file, cache_key, entries)
+
+
+def container_volumes(heights, tables):
+    """
+    Convert the heights of one frame to volumes, each with the lookup table of its own container
+    (see calibration_tables).
+    """
+    return tuple(float(heights_to_volumes(height, table)) for height, table in zip(heights, tables))
 
-            container_height1 = r1[3]
-            container_height2 = r2[3]
 
-            # Calculate the volumes for each container
-            volume1 = calculate_volume(height1, min_volume, max_volume, container_height1, shape)
-            volume2 = calculate_volume(height2, min_volume, max_volume, container_height2, shape)
+def iter_measurements(directory, rois, calibrations, workers=1, use_cache=True, decode='full',
+                      params=DETECTION_PARAMS, debug_writer=None, detector='contour', filenames=None, cache_file=None,
+                      change_detector=None, tracker=None, crops=None):
+    """
+    Stream (filename, timestamp, heights, volumes) rows, one per image, with a height and a volume per ROI.
+    filenames limits the run to part of the images in the directory, in the order given.
+    change_detector (a RoiChangeDetector) reuses the previous height of ROIs that have not changed,
+    and tracker (a MeniscusTracker) searches around the previous meniscus first.
+    Every image is decoded once and all ROIs are measured from that one buffer, or, with crops
+    (a CropCache from extract_crops), the ROIs are read from the crop cache without decoding.
+    No decoded frames are kept, so memory does not grow with the length of the run.
+    Heights of images seen in an earlier run are taken from the height cache.
+    """
+    filenames = list_images(directory) if filenames is None else filenames
+    # Without a debug writer nothing is saved, so the debug directories are not created either
+    container_dirs = (prepare_output_dirs(directory, len(rois)) if debug_writer is not None
+                      else [(None, None)] * len(rois))
+
+    decode = resolve_decode_mode(decode, rois)
+    key_params = dict(params, decode=decode, detector=detector)
+    restart_every = None
+    if detector != 'profile':
+        if change_detector is not None:
+            key_params['skip_unchanged'] = change_detector.settings()
+        if tracker is not None:
+            key_params['tracking'] = tracker.settings()
+        # A height then depends on the images since the last restart of the change detector or tracker
+        restart_every = search_restart_every(change_detector, tracker)
+        if restart_every:
+            key_params['restart_every'] = restart_every
+    cache_key = height_cache_key(rois, key_params)
+    measure = partial(measure_images, directory, rois=rois, container_dirs=container_dirs, workers=workers,
+                      decode=decode, params=params, debug_writer=debug_writer, detector=detector,
+                      change_detector=change_detector, tracker=tracker, crops=crops)
+    # The calibrations are compiled to lookup tables once, not evaluated per frame
+    tables = calibration_tables(rois, calibrations)
+
+    for filename, heights in zip(filenames, cached_measurements(directory, filenames, cache_key, measure, use_cache,
+                                                                cache_file=cache_file, restart_every=restart_every)):
+        timestamp = time.strptime(filename.split('.')[0], "%Y%m%d-%H%M%S")
+        yield filename, timestamp, heights, container_volumes(heights, tables)
+
+
+def print_search_summary(change_detector=None, tracker=None):
+    # Nothing is printed when every height came from the height cache
+    if change_detector is not None and change_detector.reused + change_detector.measured:
+        print(change_detector.summary())
+    if tracker is not None and tracker.in_band + tracker.widened + tracker.full_scans:
+        print(tracker.summary())
+
+
+def clean_volume_series(volumes, clean=None):
+    """
+    Run a batch cleaning function (remove_outliers_and_interpolate by default) over the
+    series of every container and return the cleaned volumes frame by frame again.
+    """
+    clean = clean or remove_outliers_and_interpolate
+    return list(zip(*[clean(list(container_series)) for container_series in zip(*volumes)]))
+
+
+@PROFILER.timed()
+def process_images(directory, rois, calibrations, workers=1, use_cache=True, decode='full',
+                   debug_images='all', debug_every=10, detector='contour', cleaning='batch', change_detector=None,
+                   tracker=None, crop_cache=False, params=DETECTION_PARAMS):
+    """
+    Returns the timestamps, cleaned volumes, raw heights and the image paths, with one
+    volume and height per ROI. calibrations holds a calibration dict (see load_calibration) per ROI.
+    The image paths replace the old in-memory frame list; the animation reads them back lazily.
+    debug_images is one of DebugImageWriter.POLICIES; the profile detector makes no debug images.
+    cleaning is 'batch' (remove_outliers_and_interpolate over the whole series) or
+    'streaming' (StreamingOutlierFilter, sample by sample as the images are measured).
+    change_detector (a RoiChangeDetector) skips the detection for ROIs that have not changed;
+    unchanged frames get no debug images. tracker (a MeniscusTracker) searches a band around the
+    previous meniscus first; the debug images then show the band that was searched.
+    With crop_cache, the ROI crops are extracted to the crop cache once (see extract_crops) and
+    measured from there, so later runs with other detection parameters decode nothing.
+    """
+    volumes = []
+    timestamps = []
+    raw_heights = []
+    image_paths = []
+    streamed_volumes = []
+    filters = [StreamingOutlierFilter() for _ in rois] if cleaning == 'streaming' else None
+
+    decode = resolve_decode_mode(decode, rois)
+    crops = extract_crops(directory, rois, decode, workers=workers) if crop_cache else None
+    debug_writer = None
+    if debug_images != 'off' and detector != 'profile':
+        debug_writer = DebugImageWriter(debug_images, debug_every)
+    try:
+        for filename, timestamp, heights, frame_volumes in iter_measurements(
+                directory, rois, calibrations, workers, use_cache, decode, params,
+                debug_writer=debug_writer, detector=detector, change_detector=change_detector,
+                tracker=tracker, crops=crops):
+            image_paths.append(os.path.join(directory, filename))
+            timestamps.append(timestamp)
 
             # Append the raw volumes and heights
-            volumes.append((volume1, volume2))
-            raw_heights.append((height1, height2))
+            volumes.append(frame_volumes)
+            raw_heights.append(heights)
+            if filters is not None:
+                streamed_volumes.append(tuple(f.update(v)[0] for f, v in zip(filters, frame_volumes)))
+        print_search_summary(change_detector, tracker)
+
+        if filters is not None:
+            cleaned_volumes = streamed_volumes
+        else:
+            # Remove outliers and interpolate for each container's volumes
+            cleaned_volumes = clean_volume_series(volumes)
+
+        write_outlier_debug_images(directory, [os.path.basename(path) for path in image_paths], volumes,
+                                   cleaned_volumes, rois, decode, params, debug_writer=debug_writer, detector=detector,
+                                   crops=crops)
+    finally:
+        if debug_writer is not None:
+            debug_writer.close()
+
+    return timestamps, cleaned_volumes, raw_heights, image_paths
+
+def results_header(n_containers):
+    heights = ','.join(f"Height{i + 1}" for i in range(n_containers))
+    volumes = ','.join(f"Volume{i + 1}" for i in range(n_containers))
+    return f"Timestamp,{heights},{volumes},TotalVolume\n"
+
+
+def format_result_row(timestamp, volumes, raw_heights):
+    heights = ','.join(f"{height:.2f}" for height in raw_heights)
+    container_volumes = ','.join(f"{volume:.2f}" for volume in volumes)
+    total_volume = sum(volumes)
+    return f"{time.strftime('%Y-%m-%d %H:%M:%S', timestamp)},{heights},{container_volumes},{total_volume:.2f}\n"
+
+
+@PROFILER.timed()
+def save_results(timestamps, volumes, raw_heights, output_file, image_paths=None, store_format='npz'):
+    """
+    Write volumes.csv and, unless store_format is None, the same columns in bulk to a results
+    store next to it (see save_results_store) that plotting and the animations can reload.
+    """
+    # One wide row per image: a height and a volume column for every container
+    with open(output_file, 'w') as f:
+        f.write(results_header(len(volumes[0]) if len(volumes) else 2))
+        for timestamp, frame_volumes, frame_heights in zip(timestamps, volumes, raw_heights):
+            f.write(format_result_row(timestamp, frame_volumes, frame_heights))
+    if store_format is not None:
+        save_results_store(timestamps, volumes, raw_heights, results_store_path(output_file, store_format),
+                           image_paths)
 
-    # Split volumes into container1 and container2 lists for outlier detection
-    volume1_list = [v[0] for v in volumes]
-    volume2_list = [v[1] for v in volumes]
 
-    # Remove outliers and interpolate for each container's volumes
-    clean_volume1 = remove_outliers_and_interpolate(volume1_list)
-    clean_volume2 = remove_outliers_and_interpolate(volume2_list)
+def as_datetime64(timestamps):
+    """
+    Timestamps as a datetime64[s] array of local wall-clock times, the way they appear in volumes.csv.
+    Accepts the struct_time lists of process_images as well as arrays from load_results.
+    """
+    if isinstance(timestamps, np.ndarray) and np.issubdtype(timestamps.dtype, np.datetime64):
+        return timestamps.astype('datetime64[s]')
+    return np.array([datetime(*ts[:6]) for ts in timestamps], dtype='datetime64[s]')
 
-    # Recombine the cleaned volumes
-    cleaned_volumes = list(zip(clean_volume1, clean_volume2))
 
-    return timestamps, cleaned_volumes, raw_heights, frames
-12
-def calculate_volume(height, min_volume, max_volume, container_height, shape):
-    if shape == 'cylindrical':
-        return min_volume + (height / container_height) * (max_volume - min_volume)
+def format_timestamp(timestamp, fmt='%Y-%m-%d %H:%M:%S'):
+    if isinstance(timestamp, time.struct_time):
+        return time.strftime(fmt, timestamp)
+    return np.datetime64(timestamp, 's').astype(datetime).strftime(fmt)
+
+
+def parquet_available():
+    # pandas reads and writes parquet through pyarrow or fastparquet, neither of which is required
+    return any(importlib.util.find_spec(engine) is not None for engine in ('pyarrow', 'fastparquet'))
+
+
+def results_store_path(output_file, store_format='npz'):
+    # volumes.csv -> volumes.npz or volumes.parquet
+    return f"{os.path.splitext(output_file)[0]}.{store_format}"
+
+
+@PROFILER.timed()
+def save_results_store(timestamps, volumes, raw_heights, store_file, image_paths=None):
+    """
+    Write the results as columns in one go: datetime64 timestamps and a (frames, containers) array each
+    for the heights and volumes, plus the image file names when they are known. A .npz file is written
+    with numpy alone; a .parquet file holds the volumes.csv columns (plus Image) and needs pyarrow or
+    fastparquet.
+    """
+    n_frames = len(timestamps)
+    columns = {'timestamp': as_datetime64(timestamps),
+               'heights': np.asarray(raw_heights, dtype=float).reshape(n_frames, -1),
+               'volumes': np.asarray(volumes, dtype=float).reshape(n_frames, -1)}
+    if image_paths is not None:
+        columns['image'] = np.array([os.path.basename(path) for path in image_paths], dtype=str)
+
+    if store_file.endswith('.parquet'):
+        results_frame(columns).to_parquet(store_file, index=False)
     else:
-        raise ValueError("Unsupported shape")
+        np.savez_compressed(store_file, **columns)
+    return store_file
 
 
-def save_results(timestamps, volumes, raw_heights, output_file):
-    with open(output_file, 'w') as f:
-        f.write("Timestamp,Height1,Height2,Volume1,Volume2,TotalVolume\n")
-        for timestamp, (volume1, volume2), (height1, height2) in zip(timestamps, volumes, raw_heights):
-            total_volume = volume1 + volume2
-            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S', timestamp)},{height1:.2f},{height2:.2f},{volume1:.2f},{volume2:.2f},{total_volume:.2f}\n")
+def results_frame(columns):
+    # The columns of volumes.csv as a DataFrame
+    n_containers = columns['volumes'].shape[1]
+    frame = pd.DataFrame({'Timestamp': columns['timestamp']})
+    for i in range(n_containers):
+        frame[f'Height{i + 1}'] = columns['heights'][:, i]
+    for i in range(n_containers):
+        frame[f'Volume{i + 1}'] = columns['volumes'][:, i]
+    frame['TotalVolume'] = columns['volumes'].sum(axis=1)
+    if 'image' in columns:
+        frame['Image'] = columns['image']
+    return frame
 
-def plot_volumes(timestamps, volumes):
 
+def load_results(results_file):
+    """
+    Load a finished run without touching the images: a results store (.npz or .parquet) or a
+    volumes.csv. Returns the timestamps (datetime64), the volumes and raw heights as
+    (frames, containers) arrays, and the image paths, or None when the file does not name the images.
+    """
+    directory = os.path.dirname(results_file)
+    if results_file.endswith('.npz'):
+        with np.load(results_file) as store:
+            columns = {key: store[key] for key in store.files}
+    else:
+        if results_file.endswith('.parquet'):
+            frame = pd.read_parquet(results_file)
+        else:
+            frame = pd.read_csv(results_file, parse_dates=['Timestamp'])
+        columns = {'timestamp': frame['Timestamp'].to_numpy(dtype='datetime64[s]'),
+                   'heights': frame.filter(regex=r'^Height\d+$').to_numpy(dtype=float),
+                   'volumes': frame.filter(regex=r'^Volume\d+$').to_numpy(dtype=float)}
+        if 'Image' in frame:
+            columns['image'] = frame['Image'].to_numpy(dtype=str)
+
+    image_paths = None
+    if 'image' in columns:
+        image_paths = [os.path.join(directory, name) for name in columns['image']]
+    return columns['timestamp'], columns['volumes'], columns['heights'], image_paths
+
+def minmax_indices(values, max_points):
+    """
+    Indices of a shape-preserving subset of values with at most about max_points samples: the series
+    is cut into max_points / 2 buckets of consecutive samples and the lowest and highest sample of
+    every bucket are kept, in time order, so spikes and pump-transfer steps survive the decimation.
+    The first and last sample are always kept; NaNs are skipped.
+    """
+    n = len(values)
+    if not max_points or n <= max_points:
+        return np.arange(n)
+    n_buckets = max(1, max_points // 2)
+    starts = np.linspace(0, n, n_buckets + 1).astype(int)[:-1]
+    bucket = np.repeat(np.arange(n_buckets), np.diff(np.r_[starts, n]))
+
+    kept = [np.array([0, n - 1])]
+    for reduce in (np.fmin, np.fmax):
+        # The first sample in every bucket that equals the bucket's extreme
+        extreme = reduce.reduceat(values, starts)
+        hits = np.flatnonzero(values == extreme[bucket])
+        kept.append(hits[np.unique(bucket[hits], return_index=True)[1]])
+    return np.unique(np.concatenate(kept))
+
+
+def plot_volumes(timestamps, volumes, max_points=5000):
+    """
+    Scatter plot of the volume of every container and the total. Long runs are decimated to at most
+    about max_points points per series with minmax_indices (0 plots every sample), and the samples in
+    view are decimated again at the finer resolution whenever the time axis is zoomed or panned.
+    """
     #uncomment the following for display in days instead of seconds
-    start_time = time.mktime(timestamps[0])
-    times = [(time.mktime(ts) - start_time) / (60 * 60 * 24) for ts in timestamps]
+    timestamps = as_datetime64(timestamps)
+    times = (timestamps - timestamps[0]) / np.timedelta64(1, 'D')
 
     #uncomment the following for display in seconds instead of days
-    #times = [time.mktime(ts) for ts in timestamps
-    volume1 = [v[0] for v in volumes]
-    volume2 = [v[1] for v in volumes]
-    total_volume = [v[0] + v[1] for v in volumes]
-
-    plt.scatter(times, volume1, label='Container 1', s=3)
-    plt.scatter(times, volume2, label='Container 2', s=3)
-    plt.scatter(times, total_volume, label='Total Volume', s=3)
+    #times = (timestamps - timestamps[0]) / np.timedelta64(1, 's')
+    volumes = np.asarray(volumes, dtype=float)
+    series = [volumes[:, i] for i in range(volumes.shape[1])] + [volumes.sum(axis=1)]
+    labels = [f'Container {i + 1}' for i in range(volumes.shape[1])] + ['Total Volume']
+
+    artists = []
+    for values, label in zip(series, labels):
+        shown = minmax_indices(values, max_points)
+        artists.append(plt.scatter(times[shown], values[shown], label=label, s=3))
+
+    def redecimate(ax):
+        # Decimate the visible time range only, plus one sample either side so the edges stay filled
+        low, high = ax.get_xlim()
+        start = max(0, np.searchsorted(times, low) - 1)
+        stop = min(len(times), np.searchsorted(times, high, side='right') + 1)
+        for artist, values in zip(artists, series):
+            shown = start + minmax_indices(values[start:stop], max_points)
+            artist.set_offsets(np.column_stack([times[shown], values[shown]]))
+
+    if max_points and len(times) > max_points:
+        plt.gca().callbacks.connect('xlim_changed', redecimate)
     plt.xlabel('Experiment time (days)')
     plt.ylabel('Volume (mL)')
     plt.legend()
     plt.show()
 
-def create_animation(frames, timestamps, volumes, output_file):
+def volume_colours(n_containers):
+    # Blue and orange for the first two containers and green for the total, as in the original two-container plots
+    if n_containers == 2:
+        return ['blue', 'orange', 'green']
+    return [f'C{i}' for i in range(n_containers)] + ['black']
+
+
+def panel_colours(n_containers):
+    # volume_colours as OpenCV BGR tuples
+    return [tuple(int(255 * c) for c in reversed(mcolors.to_rgb(colour))) for colour in volume_colours(n_containers)]
+
+
+def volume_label(volumes, first=1):
+    return ', '.join(f'Volume {first + i}: {volume:.2f} mL' for i, volume in enumerate(volumes))
+
+
+def read_frame(image_path, scale=1.0):
+    """
+    Read a single frame back from disk as RGB, optionally downscaled.
+    """
+    frame = cv2.imread(image_path)
+    if scale != 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+
+@PROFILER.timed()
+def create_animation(image_paths, timestamps, volumes, output_file, scale=1.0):
     fig, ax = plt.subplots()
-    ims = []
 
-    for frame, timestamp, volume in zip(frames, timestamps, volumes):
-        im = plt.imshow(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), animated=True)
-        timestamp_text = plt.text(10, frame.shape[0] - 30, time.strftime('%Y-%m-%d %H:%M:%S', timestamp),
-                                  color='white', fontsize=8, weight='bold')
-        volume_text = plt.text(10, frame.shape[0] - 15, f'Volume1: {volume[0]:.2f} mL, Volume2: {volume[1]:.2f} mL',
-                               color='white', fontsize=8, weight='bold')
-        ims.append([im, timestamp_text, volume_text])
+    # A single image and two text artists are updated in place; frames are read from disk one at a time
+    first_frame = read_frame(image_paths[0], scale)
+    im = ax.imshow(first_frame, animated=True)
+    timestamp_text = ax.text(10, first_frame.shape[0] - 30, '', color='white', fontsize=8, weight='bold')
+    volume_text = ax.text(10, first_frame.shape[0] - 15, '', color='white', fontsize=8, weight='bold')
+
+    @PROFILER.timed('animation_frame')
+    def update(i):
+        im.set_data(read_frame(image_paths[i], scale))
+        timestamp_text.set_text(format_timestamp(timestamps[i]))
+        volume_text.set_text(', '.join(f'Volume{j + 1}: {v:.2f} mL' for j, v in enumerate(volumes[i])))
+        return im, timestamp_text, volume_text
 
     plt.axis('off')  # Remove axes
     fig.subplots_adjust(left=0, right=1, top=1, bottom=0)  # Remove margins
-    ani = animation.ArtistAnimation(fig, ims, interval=200, blit=True, repeat_delay=1000)
-    ani.save(output_file, writer='pillow')
+    ani = animation.FuncAnimation(fig, update, frames=len(image_paths), interval=200, blit=True,
+                                  repeat_delay=1000)
+    ani.save(output_file, writer=StreamMovieWriter(fps=5))
 
 
-def create_combined_animation(frames, timestamps, volumes, output_file):
+@PROFILER.timed()
+def create_combined_animation(image_paths, timestamps, volumes, output_file, scale=1.0):
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 8))
-    ims = []
 
     # Convert timestamps to datetime objects for proper labeling
-    datetime_times = [datetime.fromtimestamp(time.mktime(ts)) for ts in timestamps]
-    datetime_times_num = mdates.date2num(datetime_times)  # Convert to matplotlib number format
+    datetime_times_num = mdates.date2num(as_datetime64(timestamps))  # Convert to matplotlib number format
 
-    # Separate volumes for both containers and calculate the total volume
-    volume1 = [v[0] for v in volumes]
-    volume2 = [v[1] for v in volumes]
-    total_volume = [v[0] + v[1] for v in volumes]
+    # Separate the volumes of every container and calculate the total volume
+    series = [list(container_series) for container_series in zip(*volumes)] + [[sum(v) for v in volumes]]
+    labels = [f'Container {i + 1}' for i in range(len(series) - 1)] + ['Total Volume']
+    colours = volume_colours(len(series) - 1)
 
     # Initial plot setup for the volume data (only once, not per frame)
-    ax2.plot(datetime_times_num, volume1, label='Container 1', color='blue')
-    ax2.plot(datetime_times_num, volume2, label='Container 2', color='orange')
-    ax2.plot(datetime_times_num, total_volume, label='Total Volume', color='green')
+    for values, label, colour in zip(series, labels, colours):
+        ax2.plot(datetime_times_num, values, label=label, color=colour)
 
     # Set axis labels and legend
     ax2.set_xlabel('Time')
@@ -239,26 +1565,23 @@ def create_combined_animation(frames, timestamps, volumes, output_file):
     # Rotate the time labels for readability
     fig.autofmt_xdate()
 
-    # Loop through the frames, timestamps, and volumes to create each animation frame
-    for i, (frame, timestamp, volume) in enumerate(zip(frames, timestamps, volumes)):
-        # Display the image (frame) in ax1
-        im = ax1.imshow(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), animated=True)
-
-        # Add timestamp and volume texts on the image
-        timestamp_text = ax1.text(10, frame.shape[0] - 30,
-                                  time.strftime('%Y-%m-%d %H:%M:%S', timestamp),
-                                  color='white', fontsize=8, weight='bold')
-        volume_text = ax1.text(10, frame.shape[0] - 15,
-                               f'Volume 1: {volume[0]:.2f} mL, Volume 2: {volume[1]:.2f} mL',
-                               color='white', fontsize=8, weight='bold')
-
-        # Create scatter plots to update the dots for the current frame (without clearing the axes)
-        dot1 = ax2.scatter(datetime_times_num[i], volume1[i], color='blue', zorder=5)
-        dot2 = ax2.scatter(datetime_times_num[i], volume2[i], color='orange', zorder=5)
-        dot3 = ax2.scatter(datetime_times_num[i], total_volume[i], color='green', zorder=5)
-
-        # Append the image, texts, and dots to the list of animation frames
-        ims.append([im, timestamp_text, volume_text, dot1, dot2, dot3])
+    # The image, texts and dots are created once and updated for every frame,
+    # with the frame itself read back from disk only when it is drawn
+    first_frame = read_frame(image_paths[0], scale)
+    im = ax1.imshow(first_frame, animated=True)
+    timestamp_text = ax1.text(10, first_frame.shape[0] - 30, '', color='white', fontsize=8, weight='bold')
+    volume_text = ax1.text(10, first_frame.shape[0] - 15, '', color='white', fontsize=8, weight='bold')
+    dots = [ax2.scatter(datetime_times_num[0], values[0], color=colour, zorder=5)
+            for values, colour in zip(series, colours)]
+
+    @PROFILER.timed('animation_frame')
+    def update(i):
+        im.set_data(read_frame(image_paths[i], scale))
+        timestamp_text.set_text(format_timestamp(timestamps[i]))
+        volume_text.set_text(volume_label(volumes[i]))
+        for dot, values in zip(dots, series):
+            dot.set_offsets([[datetime_times_num[i], values[i]]])
+        return (im, timestamp_text, volume_text, *dots)
 
     # Remove axis from the image subplot for cleaner visuals
     ax1.axis('off')
@@ -270,50 +1593,322 @@ def create_combined_animation(frames, timestamps, volumes, output_file):
     fig.autofmt_xdate(bottom=0.2)  # Ensure enough space for x-axis labels
 
     # Create and save the animation
-    ani = animation.ArtistAnimation(fig, ims, interval=200, blit=True, repeat_delay=1000)
-    ani.save(output_file, writer='pillow')
+    ani = animation.FuncAnimation(fig, update, frames=len(image_paths), interval=200, blit=True,
+                                  repeat_delay=1000)
+    ani.save(output_file, writer=StreamMovieWriter(fps=5))
 
-# Example usage
-if __name__ == "__main__":
-    directory = input("Enter the directory containing the images: ")
-    calibration_dir = 'calibration'
-    calibration_files = [f for f in os.listdir(calibration_dir) if f.endswith('.txt')]
+class GifStreamWriter:
+    """
+    Writes an animated GIF one frame at a time, so memory does not grow with the number of frames.
+    Each frame is quantised and LZW-encoded by Pillow as a single-frame GIF, whose image block is then
+    appended to the output with its palette moved into a local colour table.
+    Same write/release interface as cv2.VideoWriter.
+    """
 
-    print("Available calibration files:")
-    for i, file in enumerate(calibration_files):
-        print(f"{i + 1}: {file}")
+    def __init__(self, output_file, size, fps):
+        self.file = open(output_file, 'wb')
+        self.delay = max(1, int(round(100 / fps)))  # in 1/100 s
+        width, height = size
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0))
+        # Loop forever
+        self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def write(self, frame):
+        image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).quantize(256, method=Image.Quantize.FASTOCTREE)
+        buffer = io.BytesIO()
+        image.save(buffer, format='GIF')
+        data = buffer.getvalue()
+
+        packed = data[10]
+        pos = 13
+        global_table = b''
+        if packed & 0x80:
+            global_table = data[pos:pos + 3 * 2 ** ((packed & 0x07) + 1)]
+            pos += len(global_table)
+
+        # Skip any extension blocks up to the image descriptor
+        while data[pos] == 0x21:
+            pos += 2
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+
+        descriptor = bytearray(data[pos:pos + 10])
+        image_data = data[pos + 10:-1]  # the last byte is the GIF trailer
+        if not descriptor[9] & 0x80 and global_table:
+            descriptor[9] |= 0x80 | (packed & 0x07)
+            image_data = global_table + image_data
+
+        # Graphic control extension with the frame delay
+        self.file.write(b'\x21\xf9\x04\x04' + struct.pack('<H', self.delay) + b'\x00\x00')
+        self.file.write(bytes(descriptor) + image_data)
+
+    def release(self):
+        self.file.write(b'\x3b')
+        self.file.close()
+
+
+def open_video_writer(output_file, size, fps):
+    if output_file.lower().endswith('.gif'):
+        return GifStreamWriter(output_file, size, fps)
+    writer = cv2.VideoWriter(output_file, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    if not writer.isOpened():
+        raise RuntimeError(f"Could not open a video encoder for {output_file}")
+    return writer
+
+
+class StreamMovieWriter(animation.AbstractMovieWriter):
+    """
+    Matplotlib movie writer that hands every rendered figure straight to open_video_writer (a GIF
+    or MP4 by the file extension), instead of keeping all frames in memory like the pillow writer.
+    """
 
-    file_index = int(input("Select the calibration file by number: ")) - 1
-    calibration_file = os.path.join(calibration_dir, calibration_files[file_index])
-    output_file = os.path.join(directory, "volumes.csv")
-    animation_file = os.path.join(directory, "containers_combined_animation.gif")
+    def setup(self, fig, outfile, dpi=None):
+        super().setup(fig, outfile, dpi=dpi)
+        self.writer = open_video_writer(outfile, self.frame_size, self.fps)
 
-    shape, min_volume, max_volume, instructions = read_calibration(calibration_file)
+    def grab_frame(self, **savefig_kwargs):
+        buffer = io.BytesIO()
+        self.fig.savefig(buffer, **{**savefig_kwargs, 'format': 'rgba', 'dpi': self.dpi})
+        width, height = self.frame_size
+        frame = np.frombuffer(buffer.getbuffer(), dtype=np.uint8).reshape(height, width, 4)
+        self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR))
 
-    print(f"Instructions: {instructions}")
+    def finish(self):
+        self.writer.release()
 
-    # Select ROIs once
-    image_files = [f for f in sorted(os.listdir(directory)) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-    if not image_files:
-        raise FileNotFoundError("No image files found in the directory.")
 
-    sample_image_path = os.path.join(directory, image_files[0])
-    print(f"Sample image path: {sample_image_path}")  # Debugging line
-    sample_image = cv2.imread(sample_image_path)
+def decimate_indices(n_frames, max_frames):
+    if not max_frames or n_frames <= max_frames:
+        return np.arange(n_frames)
+    return np.unique(np.linspace(0, n_frames - 1, max_frames).round().astype(int))
 
-    # Check if the sample image is loaded correctly
-    if sample_image is None:
-        raise FileNotFoundError(f"Sample image not found at path: {sample_image_path}")
 
-    # Rotate the sample image 180 degrees
-    #sample_image = cv2.rotate(sample_image, cv2.ROTATE_180)
+def draw_volume_panel(timestamps, volumes, width, height):
+    """
+    Static plot of the volume traces drawn with OpenCV, plus a function that maps
+    (sample index, volume) to panel pixel coordinates for the moving markers.
+    """
+    panel = np.full((height, width, 3), 255, dtype=np.uint8)
+    left, right, bottom = 50, 10, 30
+    top = 16 + 14 * (len(volumes[0]) // 3 + 1)
+
+    times = as_datetime64(timestamps)
+    times = (times - times[0]) / np.timedelta64(1, 's')
+    volumes = np.asarray(volumes, dtype=float)
+    series = np.column_stack([volumes, volumes.sum(axis=1)])
+    low, high = np.nanmin(series), np.nanmax(series)
+    if not np.isfinite(low) or high == low:
+        low, high = 0, 1
+    span = max(times[-1], 1)
+
+    def to_pixel(i, volume):
+        x = left + times[i] / span * (width - left - right)
+        y = top + (high - volume) / (high - low) * (height - top - bottom)
+        return int(round(x)), int(round(y))
+
+    cv2.rectangle(panel, (left, top), (width - right, height - bottom), (0, 0, 0), 1)
+    for tick in np.linspace(low, high, 5):
+        _, y = to_pixel(0, tick)
+        cv2.putText(panel, f"{tick:.1f}", (5, y + 4), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 0), 1, cv2.LINE_AA)
+    for i, align in ((0, 0), (len(timestamps) - 1, 1)):
+        label = format_timestamp(timestamps[i], '%m-%d %H:%M')
+        x, _ = to_pixel(i, low)
+        cv2.putText(panel, label, (x - align * 70, height - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 0), 1,
+                    cv2.LINE_AA)
+
+    n_containers = series.shape[1] - 1
+    labels = [f'Container {i + 1}' for i in range(n_containers)] + ['Total Volume']
+    for column, (colour, label) in enumerate(zip(panel_colours(n_containers), labels)):
+        points = np.array([to_pixel(i, v) if np.isfinite(v) else (-1, -1) for i, v in enumerate(series[:, column])])
+        finite = np.isfinite(series[:, column])
+        # Draw each unbroken run of finite values as one polyline
+        for run in np.split(np.arange(len(points)), np.where(~finite)[0]):
+            run = run[finite[run]]
+            if len(run) > 1:
+                cv2.polylines(panel, [points[run].reshape(-1, 1, 2).astype(np.int32)], False, colour, 1, cv2.LINE_AA)
+        # Three legend entries per line above the plot
+        legend_position = (left + 5 + 95 * (column % 3), 18 + 14 * (column // 3))
+        cv2.putText(panel, label, legend_position, cv2.FONT_HERSHEY_SIMPLEX, 0.4, colour, 1, cv2.LINE_AA)
+    return panel, to_pixel
+
+
+@PROFILER.timed()
+def render_animation(image_paths, timestamps, volumes, output_file, scale=0.5, max_frames=300, fps=5):
+    """
+    Fast replacement for create_combined_animation. The overlays and the volume plot are drawn
+    straight onto each (downscaled) frame with OpenCV and every frame is handed to the encoder as
+    soon as it is made, so memory stays constant. Long runs are decimated to at most max_frames frames.
+    The encoder follows the extension of output_file: .gif, or a video format such as .mp4.
+    """
+    indices = decimate_indices(len(image_paths), max_frames)
+    first_frame = cv2.imread(image_paths[0])
+    height, width = int(first_frame.shape[0] * scale), int(first_frame.shape[1] * scale)
+    panel, to_pixel = draw_volume_panel(timestamps, volumes, max(width, 320), height)
+    writer = open_video_writer(output_file, (width + panel.shape[1], height), fps)
+
+    try:
+        for i in indices:
+            with PROFILER.stage('animation_imread'):
+                frame = cv2.resize(cv2.imread(image_paths[i]), (width, height), interpolation=cv2.INTER_AREA)
+            # Two containers per text line, bottom-left, with the timestamp above them
+            lines = [format_timestamp(timestamps[i])]
+            lines += [volume_label(volumes[i][j:j + 2], first=j + 1) for j in range(0, len(volumes[i]), 2)]
+            for k, line in enumerate(lines):
+                cv2.putText(frame, line, (10, height - 12 - 18 * (len(lines) - 1 - k)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+
+            current_panel = panel.copy()
+            for colour, volume in zip(panel_colours(len(volumes[i])), list(volumes[i]) + [sum(volumes[i])]):
+                if np.isfinite(volume):
+                    cv2.circle(current_panel, to_pixel(i, volume), 4, colour, -1, cv2.LINE_AA)
+            with PROFILER.stage('animation_encode'):
+                writer.write(np.hstack([frame, current_panel]))
+    finally:
+        writer.release()
 
-    r1 = cv2.selectROI("Select ROI 1", sample_image, fromCenter=False, showCrosshair=True)
-    r2 = cv2.selectROI("Select ROI 2", sample_image, fromCenter=False, showCrosshair=True)
-    cv2.destroyAllWindows()
 
-    timestamps, volumes, raw_heights, frames = process_images(directory, r1, r2, shape, min_volume, max_volume)
-    save_results(timestamps, volumes, raw_heights, output_file)
-    plot_volumes(timestamps, volumes)
-    if CREATE_ANIMATIONS:
-        create_combined_animation(frames, timestamps, volumes, animation_file)
\ No newline at end of file
+# Example usage
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track liquid volumes in a directory of images.")
+    parser.add_argument('--containers', type=int, default=2,
+                        help="Number of containers (ROIs) in each image (default: 2)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes used to analyse the images (default: 1)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Reanalyse every image instead of reusing heights from height_cache.json")
+    parser.add_argument('--debug-images', choices=DebugImageWriter.POLICIES, default='all',
+                        help="Which blur/contour debug images to save: all, every Nth frame, "
+                             "flagged frames (no meniscus found or outlier) or none")
+    parser.add_argument('--debug-every', type=int, default=10,
+                        help="Save debug images for every Nth analysed frame with --debug-images every")
+    parser.add_argument('--detector', choices=DETECTORS, default='contour',
+                        help="Meniscus detector: per-frame contour search, vectorised row profiles over batches "
+                             "of frames, or a contour search on a downscaled ROI refined at full resolution")
+    parser.add_argument('--cleaning', choices=('batch', 'streaming'), default='batch',
+                        help="Outlier cleaning: global z-score pass with interpolation, or a rolling Hampel filter "
+                             "applied sample by sample")
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help="Reuse the previous height for ROIs that have not changed since they were last measured "
+                             "(contour detector only)")
+    parser.add_argument('--change-tolerance', type=float, default=8,
+                        help="Grey levels a 4x4 pixel cell of a ROI may change by and still count as unchanged "
+                             "(default: 8)")
+    parser.add_argument('--force-every', type=int, default=30,
+                        help="Measure a ROI again after this many skips in a row (default: 30)")
+    parser.add_argument('--track', action='store_true',
+                        help="Search for the meniscus in a band around its previous position before searching the "
+                             "whole ROI (contour detector only)")
+    parser.add_argument('--track-band', type=int, default=20,
+                        help="Rows above and below the previous meniscus searched with --track (default: 20)")
+    parser.add_argument('--rescan-every', type=int, default=50,
+                        help="Search the whole ROI every this many frames with --track (default: 50)")
+    parser.add_argument('--crop-cache', action='store_true',
+                        help="Decode each image once into memory-mapped ROI crops (the roi_crops directory) and "
+                             "measure from those, so reruns with other parameters skip the JPEG decoding")
+    parser.add_argument('--detection-config',
+                        help="Take the detection parameters from this JSON config, e.g. as written by "
+                             "tune_detection.py")
+    parser.add_argument('--animate', action='store_true', help="Create the combined animation after the analysis")
+    parser.add_argument('--renderer', choices=('fast', 'matplotlib'), default='fast',
+                        help="Animation renderer: OpenCV overlays streamed to the encoder, or the original "
+                             "matplotlib animation")
+    parser.add_argument('--animation-file', help="Animation output, .gif or .mp4 "
+                                                 "(default: containers_combined_animation.gif in the image directory)")
+    parser.add_argument('--animation-frames', type=int, default=300,
+                        help="Decimate the animation to at most this many frames with the fast renderer")
+    parser.add_argument('--animation-scale', type=float, default=0.5, help="Scale factor for the animation frames")
+    parser.add_argument('--decode', choices=sorted(DECODE_MODES), default='full',
+                        help="How the JPEGs are decoded: full colour, grayscale, or grayscale at 1/2 or 1/4 scale")
+    parser.add_argument('--profile', metavar='REPORT_FILE',
+                        help="Time every stage of the run and write the timings to this JSON file")
+    parser.add_argument('--plot-points', type=int, default=5000,
+                        help="Most points plotted per series; long runs are decimated to min/max envelopes and "
+                             "refined when zooming in (0 plots every sample, default: 5000)")
+    parser.add_argument('--results-format', choices=('npz', 'parquet'), default='npz',
+                        help="Format of the results store written next to volumes.csv "
+                             "(parquet needs pyarrow or fastparquet)")
+    parser.add_argument('--from-results',
+                        help="Plot (and with --animate, animate) a finished run from its volumes.npz, "
+                             "volumes.parquet or volumes.csv instead of analysing the images")
+    args = parser.parse_args()
+    wants_parquet = args.results_format == 'parquet' or (args.from_results or '').endswith('.parquet')
+    if wants_parquet and not parquet_available():
+        # Fail now rather than after the whole analysis
+        parser.error("Parquet needs pyarrow or fastparquet (pip install pyarrow); use --results-format npz instead")
+    if args.profile:
+        PROFILER.enable()
+
+    if args.from_results:
+        # Plot (and animate) a finished run straight from its results, without analysing the images again
+        timestamps, volumes, raw_heights, image_paths = load_results(args.from_results)
+        directory = os.path.dirname(args.from_results)
+    else:
+        directory = input("Enter the directory containing the images: ")
+        calibration_dir = 'calibration'
+        calibration_files = [f for f in os.listdir(calibration_dir) if f.endswith('.txt')]
+
+        print("Available calibration files:")
+        for i, file in enumerate(calibration_files):
+            print(f"{i + 1}: {file}")
+
+        # One number is used for every container, or give one number per container
+        file_indices = [int(n) - 1 for n in input("Select the calibration file by number "
+                                                  "(or one number per container): ").split()]
+        container_calibration_files = [os.path.join(calibration_dir, calibration_files[i]) for i in file_indices]
+        output_file = os.path.join(directory, "volumes.csv")
+
+        calibrations = read_container_calibrations(container_calibration_files, args.containers)
+
+        for calibration_file in dict.fromkeys(container_calibration_files):
+            print(f"Instructions: {read_calibration(calibration_file)[3]}")
+
+        # Select ROIs once
+        image_files = [f for f in sorted(os.listdir(directory)) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+        if not image_files:
+            raise FileNotFoundError("No image files found in the directory.")
+
+        sample_image_path = os.path.join(directory, image_files[0])
+        print(f"Sample image path: {sample_image_path}")  # Debugging line
+        sample_image = cv2.imread(sample_image_path)
+
+        # Check if the sample image is loaded correctly
+        if sample_image is None:
+            raise FileNotFoundError(f"Sample image not found at path: {sample_image_path}")
+
+        # Rotate the sample image 180 degrees
+        #sample_image = cv2.rotate(sample_image, cv2.ROTATE_180)
+
+        rois = [cv2.selectROI(f"Select ROI {i + 1}", sample_image, fromCenter=False, showCrosshair=True)
+                for i in range(args.containers)]
+        cv2.destroyAllWindows()
+
+        change_detector = RoiChangeDetector(args.change_tolerance, args.force_every) if args.skip_unchanged else None
+        tracker = MeniscusTracker(args.track_band, args.rescan_every) if args.track else None
+        params = read_detection_params(args.detection_config) if args.detection_config else DETECTION_PARAMS
+        timestamps, volumes, raw_heights, image_paths = process_images(directory, rois, calibrations,
+                                                                        workers=args.workers,
+                                                                        use_cache=not args.no_cache,
+                                                                        decode=args.decode,
+                                                                        debug_images=args.debug_images,
+                                                                        debug_every=args.debug_every,
+                                                                        detector=args.detector,
+                                                                        cleaning=args.cleaning,
+                                                                        change_detector=change_detector,
+                                                                        tracker=tracker,
+                                                                        crop_cache=args.crop_cache,
+                                                                        params=params)
+        save_results(timestamps, volumes, raw_heights, output_file, image_paths, args.results_format)
+
+    animation_file = args.animation_file or os.path.join(directory, "containers_combined_animation.gif")
+    plot_volumes(timestamps, volumes, args.plot_points)
+    if CREATE_ANIMATIONS or args.animate:
+        if image_paths is None:
+            raise ValueError(f"{args.from_results} does not name the images, so the run cannot be animated")
+        if args.renderer == 'fast':
+            render_animation(image_paths, timestamps, volumes, animation_file, args.animation_scale,
+                             args.animation_frames)
+        else:
+            create_combined_animation(image_paths, timestamps, volumes, animation_file, args.animation_scale)
+    if args.profile:
+        PROFILER.write_report(args.profile)
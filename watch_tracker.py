@@ -0,0 +1,178 @@
+"""
+Long-running version of volume_tracker.py for experiments that are still running.
+
+Instead of processing a finished directory in one go, the script keeps polling the
+experiment directory and measures every new JPEG as soon as it has been fully written,
+appending one row to volumes.csv per image. Outliers are replaced as the rows are written
+by a rolling Hampel filter (StreamingOutlierFilter); run volume_tracker.py or
+animation_cluster.py afterwards for the batch-cleaned and interpolated series.
+
+State survives restarts: images already in volumes.csv are skipped, and heights of
+images that were measured before are taken from height_cache.json, so a restart only
+catches up on the images that arrived while the watcher was down. Images are tracked by name,
+so one that arrives after later ones (e.g. in a batched git pull) is still measured; its row is
+appended out of timestamp order and flagged in the log. The cache is saved every
+--save-every new heights, whenever a poll finds no new images, and on exit. The outlier filter
+is primed with the last rows of volumes.csv.
+
+Example:
+    nohup python watch_tracker.py --directory images/run_20241015-230404 \
+        --calibration calibration/greiner_15ml_conical.txt --roi 80 250 40 330 --roi 262 250 40 330 > watch.log 2>&1 &
+"""
+
+import argparse
+import os
+import time
+from collections import deque
+
+from volume_tracker import (DECODE_MODES, DETECTION_PARAMS, DETECTORS, HEIGHT_CACHE_FILE, StreamingOutlierFilter,
+                            calibration_tables, container_volumes, file_identity, format_result_row, height_cache_key,
+                            list_images, load_height_cache, measure_images, read_container_calibrations,
+                            resolve_decode_mode, results_header, save_height_cache)
+
+
+def last_saved_rows(output_file, n_rows):
+    """
+    The last n_rows rows of an existing results file as (timestamp, volumes).
+    """
+    if not os.path.exists(output_file):
+        return []
+    rows = deque(maxlen=n_rows)
+    with open(output_file, 'r') as f:
+        for line in f:
+            if line.strip() and not line.startswith("Timestamp"):
+                fields = line.strip().split(',')
+                # Timestamp, a height and a volume per container, then the total
+                n_containers = (len(fields) - 2) // 2
+                volumes = tuple(float(v) for v in fields[1 + n_containers:1 + 2 * n_containers])
+                rows.append((time.strptime(fields[0], '%Y-%m-%d %H:%M:%S'), volumes))
+    return list(rows)
+
+
+def saved_filenames(output_file):
+    # The images that already have a row in an existing results file, named after their timestamps
+    if not os.path.exists(output_file):
+        return set()
+    with open(output_file, 'r') as f:
+        return {time.strftime('%Y%m%d-%H%M%S', time.strptime(line.split(',')[0], '%Y-%m-%d %H:%M:%S')) + '.jpg'
+                for line in f if line.strip() and not line.startswith("Timestamp")}
+
+
+def image_timestamp(filename):
+    return time.strptime(filename.split('.')[0], "%Y%m%d-%H%M%S")
+
+
+def watch_directory(directory, rois, calibrations, poll_interval=0.25, decode='full',
+                    params=DETECTION_PARAMS, detector='contour', once=False, filter_options=None, save_every=50):
+    output_file = os.path.join(directory, "volumes.csv")
+    cache_file = os.path.join(directory, HEIGHT_CACHE_FILE)
+    container_dirs = [(None, None)] * len(rois)
+    tables = calibration_tables(rois, calibrations)
+
+    decode = resolve_decode_mode(decode, rois)
+    cache_key = height_cache_key(rois, dict(params, decode=decode, detector=detector))
+    cache = load_height_cache(cache_file, cache_key)
+
+    if not os.path.exists(output_file):
+        with open(output_file, 'w') as f:
+            f.write(results_header(len(rois)))
+    filters = [StreamingOutlierFilter(**(filter_options or {})) for _ in rois]
+    saved_rows = last_saved_rows(output_file, filters[0].history.maxlen)
+    # Images with a row, or skipped; anything else in the directory is still to do, however late it arrives
+    done = saved_filenames(output_file)
+    last_timestamp = None
+    if saved_rows:
+        last_timestamp = max(timestamp for timestamp, _ in saved_rows)
+        for outlier_filter, saved_volumes in zip(filters, zip(*[volumes for _, volumes in saved_rows])):
+            outlier_filter.history.extend(saved_volumes)
+        print(f"Resuming after {time.strftime('%Y-%m-%d %H:%M:%S', last_timestamp)}")
+
+    # A file is only measured once its size is the same on two consecutive polls,
+    # so images that are still being written (or pulled) are not read half-way
+    previous_sizes = {}
+    unsaved = 0
+    try:
+        while True:
+            pending = [f for f in list_images(directory) if f not in done]
+            sizes = {f: os.path.getsize(os.path.join(directory, f)) for f in pending}
+
+            handled = 0
+            for filename in pending:
+                if not once and previous_sizes.get(filename) != sizes[filename]:
+                    # Keep the rows in timestamp order: wait for this file before handling later ones
+                    break
+
+                identity = file_identity(os.path.join(directory, filename))
+                timestamp = image_timestamp(filename)
+                if filename in cache and cache[filename][0] == identity:
+                    heights = cache[filename][1]
+                else:
+                    try:
+                        heights = next(measure_images(directory, [filename], rois, container_dirs, decode=decode,
+                                                      params=params, detector=detector))
+                    except ValueError as error:
+                        # A broken image gets no row, and must not stop the images after it
+                        print(f"{filename}: skipped, {error}")
+                        done.add(filename)
+                        handled += 1
+                        continue
+                    cache[filename] = (identity, heights)
+                    unsaved += 1
+                    if unsaved >= save_every:
+                        save_height_cache(cache_file, cache_key, cache)
+                        unsaved = 0
+
+                filtered = [outlier_filter.update(volume) for outlier_filter, volume
+                            in zip(filters, container_volumes(heights, tables))]
+                volumes = tuple(volume for volume, _ in filtered)
+                with open(output_file, 'a') as f:
+                    f.write(format_result_row(timestamp, volumes, heights))
+                done.add(filename)
+                handled += 1
+                flags = " (outlier replaced)" if any(outlier for _, outlier in filtered) else ""
+                if last_timestamp is not None and timestamp < last_timestamp:
+                    flags += " (arrived late, its row is out of timestamp order)"
+                last_timestamp = max(timestamp, last_timestamp or timestamp)
+                volume_text = ', '.join(f"Volume{i + 1} {volume:.2f} mL" for i, volume in enumerate(volumes))
+                print(f"{filename}: {volume_text}{flags}")
+
+            if once:
+                return
+            if not handled and unsaved:
+                # Nothing new this poll: a good moment to write the cache
+                save_height_cache(cache_file, cache_key, cache)
+                unsaved = 0
+            previous_sizes = sizes
+            time.sleep(poll_interval)
+    finally:
+        if unsaved:
+            save_height_cache(cache_file, cache_key, cache)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch an experiment directory and track volumes as images arrive.")
+    parser.add_argument('--directory', required=True, help="Directory the images are written to")
+    parser.add_argument('--calibration', nargs='+', required=True,
+                        help="Calibration file path, or one calibration file per ROI")
+    parser.add_argument('--roi', type=int, nargs=4, action='append', required=True,
+                        help="ROI coordinates: x y width height. Repeat once per container")
+    parser.add_argument('--poll-interval', type=float, default=0.25,
+                        help="Seconds between checks for new images (default: 0.25)")
+    parser.add_argument('--decode', choices=sorted(DECODE_MODES), default='full',
+                        help="How the JPEGs are decoded (default: full)")
+    parser.add_argument('--detector', choices=DETECTORS, default='contour', help="Meniscus detector (default: contour)")
+    parser.add_argument('--max-volume', type=float, default=6,
+                        help="Volumes above this are always outliers (default: 6)")
+    parser.add_argument('--window', type=int, default=7, help="Samples in the rolling outlier window (default: 7)")
+    parser.add_argument('--n-sigmas', type=float, default=3.0,
+                        help="Robust standard deviations from the rolling median that count as an outlier")
+    parser.add_argument('--save-every', type=int, default=50,
+                        help="New heights between saves of the height cache (default: 50)")
+    parser.add_argument('--once', action='store_true', help="Process the images that are there now and exit")
+    args = parser.parse_args()
+
+    calibrations = read_container_calibrations(args.calibration, len(args.roi))
+    watch_directory(args.directory, args.roi, calibrations, args.poll_interval,
+                    args.decode, detector=args.detector, once=args.once,
+                    filter_options={'window': args.window, 'n_sigmas': args.n_sigmas, 'max_volume': args.max_volume},
+                    save_every=args.save_every)